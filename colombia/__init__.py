@@ -2,8 +2,10 @@ import atlas_core
 from atlas_core.helpers.flask import handle_api_error, APIError
 from .metadata.views import metadata_app
 from .data.views import data_app
+from .data.routing import load_classification_indexes
 
 from .core import db, cache
+from .compression import compress_response
 
 
 def create_app(config={}):
@@ -25,6 +27,17 @@ def create_app(config={}):
             response.headers.add('Access-Control-Allow-Origin', '*')
         return response
 
+    # Compress responses that aren't already, e.g. ones not from a cache
+    app.after_request(compress_response)
+
+    # Level lookups for location ids etc are served from memory, so load the
+    # classifications before we start serving
+    app.before_first_request(load_classification_indexes)
+
+    if app.config.get("DATA_ENGINE", "sql") == "columnar":
+        from .data.columnar import load_columnar_tables
+        app.before_first_request(load_columnar_tables)
+
     # Register error handler to return proper json-api errors on abort()
     app.errorhandler(APIError)(handle_api_error)
 
@@ -1,22 +1,387 @@
-from flask import jsonify
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import islice
+import keyword
+
+from flask import jsonify, current_app, stream_with_context
+from flask.json import dumps as json_dumps
 import marshmallow as ma
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
 
 from atlas_core.helpers.flask import APIError
 
+from . import formats
+
 
 def marshal(schema, data, json=True, many=True):
     """Shortcut to marshals a marshmallow schema and dump out a flask json
     response, or raise an APIError with appropriate messages otherwise."""
 
     try:
-        serialization_result = schema.dump(data, many=many)
+        serialization_result = fast_dump(schema, data, many=many)
     except ma.ValidationError as err:
         raise APIError(message=err.messages)
 
     if json:
-        return jsonify(data=serialization_result.data)
+        return jsonify(data=serialization_result)
+    else:
+        return serialization_result
+
+
+def marshal_columnar(schema, data):
+    """Like marshal(), but lays the response out by column, which saves
+    repeating every key in every row. See :py:func:`columnar_response`."""
+    try:
+        names, rows = dump_tuples(schema, data)
+    except ma.ValidationError as err:
+        raise APIError(message=err.messages)
+    return columnar_response(names, rows)
+
+
+def marshal_binary(schema, data, mimetype):
+    """Like marshal(), but encodes the response in one of the binary formats
+    in :py:mod:`colombia.formats`."""
+    try:
+        names, rows = dump_tuples(schema, data)
+    except ma.ValidationError as err:
+        raise APIError(message=err.messages)
+    return formats.binary_response(mimetype, names, rows)
+
+
+def columnar_response(names, rows):
+    """Make a {"columns": [names], "data": {name: [values]}} json response
+    out of a list of value tuples in the order of names."""
+    if len(rows) == 0:
+        columns = [[] for name in names]
+    else:
+        columns = [list(values) for values in zip(*rows)]
+    return columns_response(names, columns)
+
+
+def columns_response(names, columns):
+    """Like :py:func:`columnar_response`, but out of a list of values for
+    each name."""
+    return jsonify(columns=list(names), data=dict(zip(names, columns)))
+
+
+def dump_tuples(schema, data):
+    """Serialize rows to tuples of values instead of dicts. Returns the
+    names of the values and a list of tuples. Values that marshmallow would
+    leave out of a row (e.g. a key missing from a dict) become None."""
+    rows = list(data)
+    if len(rows) > 0:
+        serializer = compile_schema(schema, rows[0])
+        if serializer is not None:
+            try:
+                return list(serializer.names), serializer.dump_tuples(rows)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                pass
+
+    names = list(output_fields(schema))
+    return names, [tuple(row.get(name, None) for name in names)
+                   for row in fast_dump(schema, rows)]
+
+
+def stream_marshal(schema, rows, chunk_size=1000):
+    """Like marshal(), but serializes the rows in chunks as they come in
+    (e.g. from a query with yield_per()) and streams out the {"data": [...]}
+    response piece by piece, instead of building all of it in memory."""
+
+    rows = iter(rows)
+    chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+
+    # Serialize the first chunk up front, so errors become a normal error
+    # response rather than a broken stream.
+    first_chunk = next(chunks, [])
+    try:
+        first_result = fast_dump(schema, first_chunk)
+    except ma.ValidationError as err:
+        raise APIError(message=err.messages)
+
+    # Implicit field types are decided by the first row, as they would be for
+    # the whole list, so compile the serializer once from that
+    serializer = None
+    if len(first_chunk) > 0:
+        serializer = compile_schema(schema, first_chunk[0])
+
+    def dump_chunk(chunk):
+        if serializer is not None:
+            try:
+                return serializer.dump(chunk)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                pass
+        # marshmallow decides the types from the first row it's given, which
+        # has to be the first row of the response
+        return schema.dump(first_chunk[:1] + chunk, many=True).data[1:]
+
+    def generate():
+        yield '{"data": ['
+        yield ", ".join(json_dumps(row) for row in first_result)
+        for chunk in chunks:
+            rows = dump_chunk(chunk)
+            yield ", " + ", ".join(json_dumps(row) for row in rows)
+        yield "]}\n"
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype="application/json")
+
+
+def fast_dump(schema, data, many=True):
+    """Same output as schema.dump(data, many=many).data, but using a
+    serializer compiled by :py:func:`compile_schema` when the schema allows
+    it. Falls back to marshmallow otherwise."""
+
+    rows = list(data) if many else [data]
+    if len(rows) == 0:
+        return schema.dump(rows, many=many).data
+
+    serializer = compile_schema(schema, rows[0])
+    if serializer is None:
+        return schema.dump(rows if many else data, many=many).data
+
+    try:
+        result = serializer.dump(rows)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        # Odd rows (missing attributes, unconvertible values) get
+        # marshmallow's own handling of them
+        return schema.dump(rows if many else data, many=many).data
+
+    return result if many else result[0]
+
+
+def _integer(value):
+    return None if value is None else int(value)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _string(value):
+    return None if value is None else ma.utils.ensure_text_type(value)
+
+
+#: Field class -> conversion function. Fields not listed here (Nested,
+#: Method, DateTime etc) aren't compiled and go through marshmallow.
+FIELD_CONVERTERS = {
+    ma.fields.Integer: _integer,
+    ma.fields.Float: _float,
+    ma.fields.String: _string,
+    ma.fields.Field: None,
+    ma.fields.Raw: None,
+}
+
+_compiled_serializers = {}
+
+
+class CompiledSerializer(object):
+    """A row serializer generated from a schema. :py:meth:`dump` turns a list
+    of rows into a list of dicts, and :py:meth:`dump_tuples` into a list of
+    tuples in the order of :py:attr:`names`.
+
+    Rows can be ORM objects or row tuples, which are read by attribute, or
+    mappings, which are read by key and may be missing some of them."""
+
+    def __init__(self, names, getters, converters, defaults, mapping):
+        self.names = tuple(names)
+        self.mapping = mapping
+
+        namespace = {"_missing": ma.missing}
+        fields = []
+        for i, (getter, converter) in enumerate(zip(getters, converters)):
+            expression = "row[{!r}]" if mapping else "row.{}"
+            expression = expression.format(getter)
+            if converter is not None:
+                namespace["_convert_{}".format(i)] = converter
+                expression = "_convert_{}({})".format(i, expression)
+            fields.append(expression)
+
+        if mapping:
+            # Keys may be missing, so each one needs its own check
+            lines = ["def dump(rows):",
+                     "    result = []",
+                     "    for row in rows:",
+                     "        out = {}"]
+            for i, (name, getter) in enumerate(zip(names, getters)):
+                namespace["_default_{}".format(i)] = defaults[i]
+                lines.append("        if {!r} in row:".format(getter))
+                lines.append("            out[{!r}] = {}".format(name,
+                                                              fields[i]))
+                if defaults[i] is not ma.missing:
+                    lines.append("        else:")
+                    lines.append("            out[{!r}] = _default_{}"
+                                 .format(name, i))
+            lines.append("        result.append(out)")
+            lines.append("    return result")
+            self.source = "\n".join(lines)
+            exec(self.source, namespace)
+            self.dump = namespace["dump"]
+            self.dump_tuples = self._tuples_from_dicts
+        else:
+            items = ", ".join("{!r}: {}".format(name, field)
+                              for name, field in zip(names, fields))
+            values = ", ".join(fields)
+            self.source = "\n".join([
+                "def dump(rows):",
+                "    return [{{{}}} for row in rows]".format(items),
+                "def dump_tuples(rows):",
+                "    return [({},) for row in rows]".format(values),
+            ])
+            exec(self.source, namespace)
+            self.dump = namespace["dump"]
+            self.dump_tuples = namespace["dump_tuples"]
+
+    def _tuples_from_dicts(self, rows):
+        return [tuple(row.get(name, None) for name in self.names)
+                for row in self.dump(rows)]
+
+
+def _compilable(schema):
+    """Whether a schema uses only features the compiler reproduces: plain
+    fields and at most the :py:func:`fix_id_hook` post_dump."""
+    cls = type(schema)
+    if schema.extra or schema.prefix or cls.__accessor__ is not None:
+        return False
+    if cls.__data_handlers__ or cls.__error_handler__ is not None:
+        return False
+    for (tag, raw), processors in cls.__processors__.items():
+        if not processors or tag not in (PRE_DUMP, POST_DUMP):
+            continue
+        if tag == POST_DUMP and not raw and \
+                all(getattr(cls, name) is fix_id_hook for name in processors):
+            continue
+        return False
+    return True
+
+
+def _field_names(schema):
+    """Output field names in the same way as marshmallow's _update_fields."""
+    declared = list(schema.declared_fields)
+    if schema.only:
+        names = list(schema.only)
+    elif schema.opts.fields:
+        names = list(schema.opts.fields)
+    elif schema.opts.additional:
+        names = declared + [name for name in schema.opts.additional
+                            if name not in declared]
     else:
-        return serialization_result.data
+        names = declared
+    excludes = set(schema.opts.exclude) | set(schema.exclude)
+    return [name for name in names if name not in excludes]
+
+
+def schema_attributes(schema):
+    """Names of the attributes the schema reads off each row, e.g. to select
+    only those columns from the database."""
+    attributes = []
+    for name in _field_names(schema):
+        field = schema.declared_fields.get(name, None)
+        attribute = getattr(field, "attribute", None) or name
+        if attribute not in attributes:
+            attributes.append(attribute)
+    return attributes
+
+
+def output_fields(schema):
+    """Map the names of the fields in the schema's output to the names of the
+    schema fields, which differ for location_id when the schema uses
+    :py:func:`fix_id_hook`."""
+    id_field_name = None
+    if type(schema).__processors__.get((POST_DUMP, False)):
+        id_field_name = schema.context.get("id_field_name", None)
+
+    names = OrderedDict()
+    for name in _field_names(schema):
+        if name == "location_id" and id_field_name is not None:
+            names[id_field_name] = name
+        else:
+            names[name] = name
+    return names
+
+
+def project(schema, names):
+    """A copy of the schema that only outputs the given schema fields."""
+    return type(schema)(many=schema.many, only=tuple(names),
+                        context=dict(schema.context))
+
+
+def compile_schema(schema, prototype):
+    """Compile a serializer for the schema, given the first row of the data
+    (which like in marshmallow decides the type of implicit fields). Returns
+    None if the schema can't be compiled. Serializers are cached."""
+
+    if not _compilable(schema):
+        return None
+
+    mapping = isinstance(prototype, Mapping)
+    names = _field_names(schema)
+
+    fields = []
+    for name in names:
+        field = schema.declared_fields.get(name, None)
+        if field is None:
+            try:
+                if mapping:
+                    value = prototype[name]
+                else:
+                    value = getattr(prototype, name)
+            except (AttributeError, KeyError):
+                # marshmallow raises here, let it.
+                return None
+            field = schema.TYPE_MAPPING.get(type(value), ma.fields.Field)
+        else:
+            if field.load_only:
+                continue
+        fields.append((name, field))
+
+    has_id_hook = bool(type(schema).__processors__.get((POST_DUMP, False)))
+    id_field_name = schema.context.get("id_field_name", None)
+    if has_id_hook and id_field_name is None:
+        raise ma.ValidationError(
+            "Please set schema.context['id_field_name']."
+        )
+
+    # Declared fields come from the class, so only implicit field types vary
+    cache_key = (type(schema), tuple(schema.only or ()),
+                 tuple(schema.exclude or ()),
+                 tuple((name, field) for name, field in fields
+                       if isinstance(field, type)),
+                 id_field_name if has_id_hook else None, mapping)
+    serializer = _compiled_serializers.get(cache_key, None)
+    if serializer is not None:
+        return serializer
+
+    out_names, getters, converters, defaults = [], [], [], []
+    for name, field in fields:
+        field_class = field if isinstance(field, type) else type(field)
+        if field_class not in FIELD_CONVERTERS:
+            return None
+        if getattr(field, "as_string", False):
+            return None
+
+        attribute = getattr(field, "attribute", None) or name
+        if mapping and attribute in dir(dict):
+            # marshmallow falls back to getattr(), e.g. row.items
+            return None
+        if not attribute.isidentifier() or keyword.iskeyword(attribute):
+            # e.g. "a.b", which marshmallow looks up as nested attributes
+            return None
+
+        default = getattr(field, "default", ma.missing)
+        if callable(default):
+            return None
+
+        if has_id_hook and name == "location_id":
+            name = id_field_name
+        out_names.append(name)
+        getters.append(attribute)
+        converters.append(FIELD_CONVERTERS[field_class])
+        defaults.append(default)
+
+    serializer = CompiledSerializer(out_names, getters, converters, defaults,
+                                    mapping)
+    _compiled_serializers[cache_key] = serializer
+    return serializer
 
 
 def fix_id_hook(self, data):
@@ -31,10 +396,9 @@ def fix_id_hook(self, data):
             "Please set schema.context['id_field_name']."
         )
 
-    value = data["location_id"]
-    del data["location_id"]
-
-    data[key] = value
+    # Not there if the request narrowed down the fields with ?fields=
+    if "location_id" in data:
+        data[key] = data.pop("location_id")
     return data
 
 
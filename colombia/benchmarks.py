@@ -0,0 +1,282 @@
+"""Benchmarks for the hot paths of the API, run with ``python manage.py
+benchmark``. They run against whatever database the app is configured with,
+so they need an imported dataset to give meaningful numbers."""
+
+from collections import OrderedDict
+from itertools import product
+import random
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from .core import db
+from . import api_schemas as schemas
+from .data import models
+from .data.views import schema_query, rectangularize
+
+
+def measure(func, repeat=5):
+    """Run func a few times and return the best wall time in seconds and the
+    peak memory allocated during one run, in bytes."""
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        db.session.expunge_all()
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        db.session.expunge_all()
+
+    return min(timings), peak
+
+
+#: municipality level table -> schema it's served with
+MUNICIPALITY_TABLES = OrderedDict([
+    (models.MunicipalityProductYear, schemas.XProductYearSchema),
+    (models.MunicipalityIndustryYear, schemas.XIndustryYearSchema),
+    (models.MunicipalityLivestockYear, schemas.XLivestockYearSchema),
+    (models.MunicipalityAgriculturalProductYear,
+     schemas.XAgriculturalProductYearSchema),
+    (models.MunicipalityNonagYear, schemas.XNonagriculturalActivityYearSchema),
+    (models.MunicipalityLandUseYear, schemas.XLandUseYearSchema),
+    (models.MunicipalityFarmTypeYear, schemas.XFarmTypeYearSchema),
+    (models.MunicipalityFarmSizeYear, schemas.XFarmSizeYearSchema),
+    (models.CountryMunicipalityYear, schemas.CountryXYearSchema),
+])
+
+
+def largest_location(model):
+    """The location_id with the most rows in a table, or None if empty."""
+    row = db.session\
+        .query(model.location_id, db.func.count().label("num_rows"))\
+        .group_by(model.location_id)\
+        .order_by(db.desc("num_rows"))\
+        .first()
+    return None if row is None else row.location_id
+
+
+def benchmark_row_tuples(repeat=5):
+    """Compare querying and serializing whole ORM instances against selecting
+    only the schema's columns as row tuples, for the largest location in
+    each municipality level table. Yields one dict of results per table."""
+
+    for model, schema_class in MUNICIPALITY_TABLES.items():
+        location_id = largest_location(model)
+        if location_id is None:
+            continue
+
+        schema = schema_class(many=True)
+        schema.context = {"id_field_name": "municipality_id"}
+
+        def orm_instances():
+            rows = model.query.filter_by(location_id=location_id).all()
+            return schemas.marshal(schema, rows, json=False)
+
+        def row_tuples():
+            rows = schema_query(model, schema)\
+                .filter_by(location_id=location_id)\
+                .all()
+            return schemas.marshal(schema, rows, json=False)
+
+        assert orm_instances() == row_tuples()
+
+        before_time, before_memory = measure(orm_instances, repeat)
+        after_time, after_memory = measure(row_tuples, repeat)
+        yield OrderedDict([
+            ("table", model.__tablename__),
+            ("rows", len(row_tuples())),
+            ("orm_ms", before_time * 1000),
+            ("tuples_ms", after_time * 1000),
+            ("orm_kb", before_memory / 1024),
+            ("tuples_kb", after_memory / 1024),
+        ])
+
+
+def rectangularize_reference(data, keys):
+    """The original pure python :py:func:`~colombia.data.views.rectangularize`,
+    kept to benchmark and test the current one against."""
+
+    if(len(data) == 0):
+        return []
+
+    unique_values = OrderedDict()
+    all_keys = set()
+    index = {}
+
+    for i, line in enumerate(data):
+
+        # Collect unique values for each key
+        for key in keys:
+            unique_values.setdefault(key, set())
+            unique_values[key].add(line[key])
+
+        # Build an index where we can look up stuff in the list by value
+        values = tuple(line[key] for key in keys)
+        index[values] = i
+
+        # Collect names of keys just so we have all possible names of keys in
+        # the list
+        all_keys.update(line.keys())
+
+    # Generate all combos of the unique values by doing a cartesian product
+    all_combos = product(*unique_values.values())
+
+    # Make a new list, creating entries for combos that didn't exist in the old
+    # list
+    new_list = []
+    for combo in all_combos:
+        if combo in index:
+            entry_index = index[combo]
+            new_list.append(data[entry_index])
+        else:
+            new_list.append(dict(zip(keys, combo)))
+
+    return new_list
+
+
+def partner_trade_rows(num_countries, num_years, density=0.7, seed=0):
+    """Fake eeey_location_products rows: trade with each partner country in
+    some of the years."""
+    rng = random.Random(seed)
+    rows = []
+    for country_id, year in product(range(num_countries),
+                                    range(2000, 2000 + num_years)):
+        if rng.random() < density:
+            rows.append({"country_id": country_id, "product_id": 1,
+                         "year": year, "export_value": rng.random(),
+                         "import_value": rng.random()})
+    rng.shuffle(rows)
+    return rows
+
+
+def benchmark_rectangularize(repeat=5):
+    """Compare rectangularize() against the original implementation for a
+    range of partner country x year grid sizes."""
+    keys = ["country_id", "product_id", "year"]
+    for num_countries, num_years in [(50, 10), (250, 10), (250, 40),
+                                     (1000, 40)]:
+        rows = partner_trade_rows(num_countries, num_years)
+        assert rectangularize(rows, keys) == \
+            rectangularize_reference(rows, keys)
+
+        before_time, before_memory = measure(
+            lambda: rectangularize_reference(rows, keys), repeat)
+        after_time, after_memory = measure(
+            lambda: rectangularize(rows, keys), repeat)
+        yield OrderedDict([
+            ("grid", "{}x{}".format(num_countries, num_years)),
+            ("rows", len(rows)),
+            ("before_ms", before_time * 1000),
+            ("after_ms", after_time * 1000),
+            ("before_kb", before_memory / 1024),
+            ("after_kb", after_memory / 1024),
+        ])
+
+
+# The reducers of datasets.py, which can't be imported without the source data
+def first(x):
+    return x.nth(0)
+first.aggregation = "first"
+
+
+def sum_group(x):
+    return x.sum()
+sum_group.aggregation = "sum"
+
+
+def aggregate_facet_reference(df, facet_fields, aggregations):
+    """The original facet aggregation of
+    :py:func:`~colombia.dataset_tools.process_dataset`, one groupby
+    aggregation per column, kept to benchmark and test
+    :py:func:`~colombia.dataset_tools.aggregate_facet` against."""
+    facet_groupby = df.groupby(facet_fields)
+    agg_outputs = []
+    for agg_field, agg_func in aggregations.items():
+        agg_outputs.append(agg_func(facet_groupby[[agg_field]]))
+    return pd.concat(agg_outputs, axis=1)
+
+
+def rcpy_rows(num_rows, num_locations=1100, num_countries=200,
+              num_products=1200, num_years=10, seed=0):
+    """Fake trade4digit_rcpy_municipality rows after the classification
+    merges, with random keys."""
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        "country_id": rng.randint(0, num_countries, num_rows),
+        "location_id": rng.randint(0, num_locations, num_rows),
+        "product_id": rng.randint(0, num_products, num_rows),
+        "year": rng.randint(2000, 2000 + num_years, num_rows),
+    }).drop_duplicates()
+    for column in ["export_value", "import_value"]:
+        df[column] = rng.rand(len(df)) * 10 ** 6
+    for column in ["export_num_plants", "import_num_plants"]:
+        df[column] = rng.randint(0, 20, len(df))
+    return df.reset_index(drop=True)
+
+
+def benchmark_facets(repeat=5):
+    """Compare aggregate_facet() against the original per column
+    aggregation, on the facets of the rcpy municipality dataset."""
+    # Needs the ingestion requirements
+    from .dataset_tools import aggregate_facet
+
+    facets = OrderedDict([
+        (("country_id", "location_id", "product_id", "year"), OrderedDict([
+            ("export_value", first),
+            ("export_num_plants", first),
+            ("import_value", first),
+            ("import_num_plants", first),
+        ])),
+        (("country_id", "location_id", "year"), OrderedDict([
+            ("export_value", sum_group),
+            ("export_num_plants", sum_group),
+            ("import_value", sum_group),
+            ("import_num_plants", sum_group),
+        ])),
+    ])
+
+    for num_rows in [10 ** 4, 10 ** 5, 10 ** 6]:
+        df = rcpy_rows(num_rows)
+        for facet_fields, aggregations in facets.items():
+            assert aggregate_facet(df, facet_fields, aggregations).equals(
+                aggregate_facet_reference(df, facet_fields, aggregations))
+
+            before_time, before_memory = measure(
+                lambda: aggregate_facet_reference(df, facet_fields,
+                                                  aggregations), repeat)
+            after_time, after_memory = measure(
+                lambda: aggregate_facet(df, facet_fields, aggregations),
+                repeat)
+            yield OrderedDict([
+                ("facet", "/".join(field.replace("_id", "")
+                                   for field in facet_fields)),
+                ("rows", len(df)),
+                ("before_ms", before_time * 1000),
+                ("after_ms", after_time * 1000),
+                ("before_kb", before_memory / 1024),
+                ("after_kb", after_memory / 1024),
+            ])
+
+
+def print_results(results):
+    """Print benchmark result dicts as a table."""
+    results = list(results)
+    if not results:
+        print("Nothing to benchmark, is the database empty?")
+        return
+
+    columns = list(results[0].keys())
+    print("  ".join("{:>12}".format(column) for column in columns))
+    for result in results:
+        print("  ".join(
+            "{:>12.1f}".format(value) if isinstance(value, float)
+            else "{:>12}".format(value)
+            for value in result.values()))
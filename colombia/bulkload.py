@@ -0,0 +1,130 @@
+"""Bulk loading of DataFrames into the fact tables, for the import. Going
+through :py:meth:`pandas.DataFrame.to_sql` sends every chunk as a separate
+executemany of INSERTs, so this uses the fastest path each database has:
+
+- PostgreSQL: COPY FROM STDIN, fed csv from an in memory buffer.
+- SQLite: one executemany of a prepared INSERT per chunk, all in one
+  transaction, with syncing and the rollback journal on disk turned off for
+  the duration.
+- Anything else: to_sql.
+
+Indexes aren't touched here, the import drops them before loading anything
+and builds them afterwards, see :py:mod:`colombia.indexes`."""
+
+from collections import namedtuple
+from io import StringIO
+import time
+
+import pandas as pd
+from sqlalchemy import Integer
+
+from .core import db
+
+LoadStats = namedtuple("LoadStats", ["table", "rows", "seconds"])
+
+
+def rows_per_second(stats):
+    if stats.seconds == 0:
+        return float(stats.rows)
+    return stats.rows / stats.seconds
+
+
+def format_stats(stats):
+    return "Loaded {} rows into {} in {:.1f}s ({:.0f} rows/s)".format(
+        stats.rows, stats.table, stats.seconds, rows_per_second(stats))
+
+
+def column_values(series):
+    """A column as a list of python values, with None for nulls."""
+    if series.isnull().any():
+        series = series.astype(object).where(series.notnull(), None)
+    return series.tolist()
+
+
+def integer_values(series):
+    """A float column of whole numbers as ints and Nones, so that it goes to
+    csv as 3 rather than 3.0. Pandas makes integer columns floats whenever
+    they have nulls."""
+    return pd.Series([None if pd.isnull(value) else int(value)
+                      for value in series],
+                     index=series.index, dtype=object)
+
+
+def load_sqlite(connection, table, df, chunk_size):
+    statement = "INSERT INTO {} ({}) VALUES ({})".format(
+        table.name, ", ".join(df.columns), ", ".join("?" for c in df.columns))
+
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA synchronous")
+    synchronous = cursor.fetchone()[0]
+    cursor.execute("PRAGMA journal_mode")
+    journal_mode = cursor.fetchone()[0]
+
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA journal_mode = MEMORY")
+    try:
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            cursor.executemany(statement, zip(*[column_values(chunk[column])
+                                                for column in chunk.columns]))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.execute("PRAGMA synchronous = {}".format(synchronous))
+        cursor.execute("PRAGMA journal_mode = {}".format(journal_mode))
+        cursor.close()
+
+
+def load_postgresql(connection, table, df, chunk_size):
+    statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        table.name, ", ".join(df.columns))
+
+    cursor = connection.cursor()
+    try:
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size].copy()
+            for column in chunk.columns:
+                if isinstance(table.c[column].type, Integer) and \
+                        chunk[column].dtype.kind == "f":
+                    chunk[column] = integer_values(chunk[column])
+            buffer = StringIO()
+            chunk.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+LOADERS = {
+    "sqlite": load_sqlite,
+    "postgresql": load_postgresql,
+}
+
+
+def bulk_load(df, table_name, engine=None, chunk_size=100000):
+    """Append the rows of df to a table with the fastest method the database
+    has. Returns :py:class:`LoadStats` for the load."""
+    if engine is None:
+        engine = db.engine
+
+    start = time.perf_counter()
+    table = db.metadata.tables.get(table_name, None)
+    loader = LOADERS.get(engine.dialect.name, None)
+
+    if table is None or loader is None:
+        df.to_sql(table_name, engine, index=False, chunksize=10000,
+                  if_exists="append")
+    elif len(df) > 0:
+        connection = engine.raw_connection()
+        try:
+            loader(connection, table, df, chunk_size)
+        finally:
+            connection.close()
+
+    return LoadStats(table_name, len(df), time.perf_counter() - start)
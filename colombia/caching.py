@@ -0,0 +1,148 @@
+"""Response caching for the API. The data only changes when an import runs,
+so responses are cached under a key built from the dataset version, the
+normalized request path and the query parameters that affect the response.
+A new import stamps a new version, so stale entries are simply never looked
+up again.
+
+The backend is whatever flask-cache is configured with (CACHE_TYPE = "simple",
+"filesystem", "redis", ...)."""
+
+from functools import wraps
+import hashlib
+
+from flask import current_app, request, make_response
+
+from . import formats
+from .compression import compress_response, negotiate_encoding
+from .core import cache
+from .snapshots import snapshot_entry, snapshot_encoding, snapshot_response
+from .versioning import dataset_version
+
+#: Query string parameters that change the response, and so must be part of
+#: the cache key. Anything else in the query string is ignored.
+CACHE_KEY_PARAMS = ["level", "from_level", "to_level", "year", "from_year",
+                    "to_year", "fields", "format", "ids"]
+
+
+def normalized_path(path):
+    """Collapse repeated slashes and make sure there is a trailing slash, so
+    that /data/product//4/exporters and /data/product/4/exporters/ share a
+    cache entry."""
+    parts = [part for part in path.split("/") if part]
+    return "/" + "/".join(parts) + "/"
+
+
+def normalized_request():
+    """The path plus the cache-relevant query parameters, in a fixed order."""
+    params = []
+    for name in CACHE_KEY_PARAMS:
+        value = request.args.get(name, None)
+        if value is None:
+            continue
+        if name == "fields":
+            # The order of the fields doesn't change the response
+            fields = set(field.strip() for field in value.split(","))
+            value = ",".join(sorted(field for field in fields if field))
+        elif name == "ids":
+            # Neither does the order of the ids
+            ids = set(entity_id.strip() for entity_id in value.split(","))
+            value = ",".join(sorted(entity_id for entity_id in ids
+                                    if entity_id))
+        params.append("{}={}".format(name, value.strip()))
+
+    # Binary formats are picked by the Accept header rather than a param
+    mimetype = formats.negotiate()
+    if mimetype != formats.JSON:
+        params.append("accept={}".format(mimetype))
+
+    return normalized_path(request.path) + "?" + "&".join(params)
+
+
+def response_cache_key(encoding):
+    """Cache key for the response to the current request, served with the
+    given encoding. Responses are cached compressed, so there's one entry per
+    encoding."""
+    return "response:{}:{}:{}".format(dataset_version(), encoding,
+                                      normalized_request())
+
+
+def response_etag(encoding):
+    """A strong ETag for the response to the current request, served with the
+    given encoding. Responses only change when the dataset version does, so
+    the ETag can be computed without running the view."""
+    return hashlib.sha1(response_cache_key(encoding).encode("utf-8"))\
+        .hexdigest()
+
+
+def add_cache_headers(response, etag):
+    """Set the ETag, and the Cache-Control max-age configured for the
+    current blueprint in CACHE_CONTROL_MAX_AGE, if any."""
+    response.set_etag(etag)
+    max_ages = current_app.config.get("CACHE_CONTROL_MAX_AGE", {})
+    max_age = max_ages.get(request.blueprint, None)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+def cached_response(view):
+    """Answer conditional requests with a 304 if the client already has the
+    current response, and otherwise serve the view from the precomputed
+    snapshots or the response cache when possible, caching its successful
+    responses."""
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+
+        # Snapshots are only stored gzipped, so they can be served with a
+        # different encoding than a live response would be
+        snapshot = snapshot_entry(normalized_request())
+        if snapshot is not None:
+            encoding = snapshot_encoding()
+        else:
+            encoding = negotiate_encoding()
+
+        etag = response_etag(encoding)
+        if request.if_none_match.contains_weak(etag):
+            return add_cache_headers(current_app.response_class(status=304),
+                                     etag)
+
+        if snapshot is not None:
+            response = snapshot_response(snapshot)
+        else:
+            response = response_from_caches(encoding, view, *args, **kwargs)
+        if response.status_code == 200:
+            add_cache_headers(response, etag)
+        return response
+
+    return cached_view
+
+
+def response_from_caches(encoding, view, *args, **kwargs):
+    """Get the response from the response cache or, failing that, the view.
+    encoding is the negotiated one, part of the cache key."""
+
+    if not current_app.config.get("RESPONSE_CACHE", True):
+        return make_response(view(*args, **kwargs))
+
+    key = response_cache_key(encoding)
+    entry = cache.get(key)
+    if entry is not None:
+        response = current_app.response_class(entry["body"],
+                                              mimetype=entry["mimetype"])
+        if entry["encoding"] is not None:
+            response.headers["Content-Encoding"] = entry["encoding"]
+        return response
+
+    response = make_response(view(*args, **kwargs))
+    if response.status_code == 200 and not response.is_streamed:
+        compress_response(response)
+        entry = {
+            "body": response.get_data(),
+            "mimetype": response.mimetype,
+            "encoding": response.headers.get("Content-Encoding", None),
+        }
+        cache.set(key, entry,
+                  timeout=current_app.config.get("RESPONSE_CACHE_TIMEOUT"))
+    return response
@@ -0,0 +1,80 @@
+"""Response compression, negotiated by Accept-Encoding. gzip is always
+available, brotli when the brotli package is installed (see
+requirements-optimizations.txt).
+
+Responses from the response cache are cached already compressed, one entry
+per encoding, and snapshots are stored gzipped, so the same body isn't
+compressed again on every request."""
+
+from functools import lru_cache
+import gzip
+
+from flask import current_app, request
+
+#: Content types worth compressing. Everything we serve is, but this keeps
+#: us from compressing e.g. images if any are ever added.
+COMPRESSIBLE_MIMETYPES = ["application/json", "application/x-msgpack",
+                          "application/vnd.apache.arrow.stream", "text/html",
+                          "text/plain", "text/csv"]
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+@lru_cache(maxsize=None)
+def available_encodings():
+    """Encodings we can compress with, most preferred first."""
+    encodings = []
+    try:
+        import brotli  # noqa
+        encodings.append("br")
+    except ImportError:
+        pass
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate_encoding(encodings=None):
+    """The encoding to compress the response to the current request with, out
+    of encodings or everything available, or None to leave it
+    uncompressed."""
+    if not current_app.config.get("COMPRESS", True):
+        return None
+    if encodings is None:
+        encodings = available_encodings()
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    elif encoding == "br":
+        import brotli
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError("Unknown encoding {}".format(encoding))
+
+
+def compress_response(response):
+    """Compress a response in place with the negotiated encoding, if it's
+    worth it. Registered as an after_request hook by create_app, and also
+    called by the response cache before storing responses."""
+
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code != 200 or response.is_streamed or \
+            response.direct_passthrough or \
+            "Content-Encoding" in response.headers or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    body = response.get_data()
+    if len(body) < current_app.config.get("COMPRESS_MIN_SIZE", 500):
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
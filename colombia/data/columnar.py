@@ -0,0 +1,241 @@
+"""An optional in-memory serving engine for the largest fact tables. With
+DATA_ENGINE = "columnar", each worker loads the XProductYear and XIndustryYear
+tables into numpy column arrays when it starts, sorted and indexed by the
+columns the API filters on. Requests then slice arrays instead of hydrating
+one ORM object per row.
+
+Responses are identical to the SQL path: rows come out in primary key order
+within each slice, with NULLs as None. Requires numpy, see
+requirements-optimizations.txt."""
+
+from flask import current_app
+import marshmallow as ma
+import numpy as np
+
+from ..core import db
+from ..versioning import dataset_version
+from .. import api_schemas as schemas
+from .models import (CountryProductYear, DepartmentProductYear, MSAProductYear,
+                     MunicipalityProductYear, CountryIndustryYear,
+                     DepartmentIndustryYear, MSAIndustryYear,
+                     MunicipalityIndustryYear)
+
+#: model -> (schema whose fields to load, keys to index rows by)
+COLUMNAR_TABLES = {
+    CountryProductYear: (schemas.XProductYearSchema,
+                         [("location_id", "level"), ("product_id",)]),
+    DepartmentProductYear: (schemas.XProductYearSchema,
+                            [("location_id", "level"), ("product_id",)]),
+    MSAProductYear: (schemas.XProductYearSchema,
+                     [("location_id", "level"), ("product_id",)]),
+    MunicipalityProductYear: (schemas.XProductYearSchema,
+                              [("location_id", "level"), ("product_id",)]),
+    CountryIndustryYear: (schemas.XIndustryYearSchema,
+                          [("location_id", "level"), ("industry_id",)]),
+    DepartmentIndustryYear: (schemas.XIndustryYearSchema,
+                             [("location_id", "level"), ("industry_id",)]),
+    MSAIndustryYear: (schemas.XIndustryYearSchema,
+                      [("location_id", "level"), ("industry_id",)]),
+    MunicipalityIndustryYear: (schemas.XIndustryYearSchema,
+                               [("location_id", "level"), ("industry_id",)]),
+}
+
+LOAD_CHUNK_SIZE = 50000
+
+
+class Column(object):
+    """A numpy array of values plus a mask of which ones are NULL."""
+
+    def __init__(self, values, python_type):
+        self.mask = np.array([value is None for value in values], dtype=bool)
+
+        if python_type is int:
+            values = [0 if value is None else value for value in values]
+            self.values = np.array(values, dtype=np.int64)
+        elif python_type is float:
+            values = [np.nan if value is None else value for value in values]
+            self.values = np.array(values, dtype=np.float64)
+        else:
+            self.values = np.array(values, dtype=object)
+
+        if not self.mask.any():
+            self.mask = None
+
+    def tolist(self, positions, as_float=False):
+        """Native python values at the given row positions, NULLs as None,
+        optionally converted to floats."""
+        values = self.values[positions]
+        if as_float and values.dtype.kind in "iu":
+            values = values.astype(np.float64)
+        values = values.tolist()
+        if self.mask is not None:
+            for i in np.flatnonzero(self.mask[positions]).tolist():
+                values[i] = None
+        return values
+
+
+class ColumnarTable(object):
+    """One fact table held as columns, with an index from each key (a tuple
+    of column values) to the row positions that have it."""
+
+    def __init__(self, model, fields, keys):
+        self.model = model
+        self.fields = [field for field in fields if hasattr(model, field)]
+        self.field_set = set(self.fields)
+        self.keys = keys
+        self.columns = {}
+        self.indexes = {}
+
+    def load(self):
+        columns = sorted(set(self.fields) |
+                         set(name for key in self.keys for name in key))
+        q = db.session\
+            .query(*[getattr(self.model, name) for name in columns])\
+            .order_by(self.model.id)\
+            .yield_per(LOAD_CHUNK_SIZE)
+
+        values = {name: [] for name in columns}
+        for row in q:
+            for name, value in zip(columns, row):
+                values[name].append(value)
+
+        for name in columns:
+            column = getattr(self.model, name)
+            try:
+                python_type = column.type.python_type
+            except (AttributeError, NotImplementedError):
+                python_type = object
+            self.columns[name] = Column(values[name], python_type)
+
+        for key in self.keys:
+            self.indexes[key] = self.build_index(key)
+
+        return self
+
+    def build_index(self, key):
+        """Sort rows by the key columns and map each key value to its run of
+        row positions. The sort is stable, so rows stay in primary key
+        order within a run."""
+        key_columns = [self.columns[name] for name in key]
+        if len(key_columns[0].values) == 0:
+            return {}
+
+        # lexsort sorts by the last array first. It's slow on object arrays
+        # like the level strings, so those are sorted by integer codes.
+        codes = [codes_of(c) for c in key_columns]
+        order = np.lexsort(list(reversed(codes)))
+
+        changed = np.zeros(len(order) - 1, dtype=bool)
+        for key_codes in codes:
+            sorted_codes = key_codes[order]
+            changed |= sorted_codes[1:] != sorted_codes[:-1]
+        starts = np.concatenate([[0], np.flatnonzero(changed) + 1])
+        stops = np.concatenate([starts[1:], [len(order)]])
+
+        key_values = zip(*[c.tolist(order[starts]) for c in key_columns])
+        return {
+            key_value: order[start:stop]
+            for key_value, start, stop
+            in zip(key_values, starts.tolist(), stops.tolist())
+        }
+
+    def positions(self, key, key_value):
+        """Row positions for a key, e.g. (("location_id", "level"), (5,
+        "4digit")). Empty if there are no such rows."""
+        return self.indexes[key].get(tuple(key_value),
+                                     np.array([], dtype=np.int64))
+
+    def select(self, key, key_value, years=None):
+        """Rows for a key value. years is an optional (from_year, to_year)
+        range like :py:func:`colombia.data.views.get_years` returns."""
+        positions = self.positions(key, key_value)
+        if years is not None:
+            year = self.columns["year"]
+            keep = np.ones(len(positions), dtype=bool)
+            if year.mask is not None:
+                keep &= ~year.mask[positions]
+            from_year, to_year = years
+            if from_year is not None:
+                keep &= year.values[positions] >= from_year
+            if to_year is not None:
+                keep &= year.values[positions] <= to_year
+            positions = positions[keep]
+        return Selection(self, positions)
+
+
+class Selection(object):
+    """The rows of a :py:class:`ColumnarTable` at some positions, which get
+    serialized straight from the column arrays."""
+
+    def __init__(self, table, positions):
+        self.table = table
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def columns(self, schema):
+        """The values of each field in the schema's output, like
+        :py:func:`~colombia.api_schemas.dump_tuples` gives them but as one
+        list per field. Returns the output names, the lists, and the names of
+        fields that the table doesn't have and that have no default, which
+        marshal() would leave out of rows."""
+        names, columns, missing = [], [], set()
+        for name, field_name in schemas.output_fields(schema).items():
+            field = schema.declared_fields.get(field_name, None)
+            attribute = getattr(field, "attribute", None) or field_name
+            names.append(name)
+
+            if attribute not in self.table.field_set:
+                default = getattr(field, "default", ma.missing)
+                if default is ma.missing:
+                    missing.add(name)
+                    default = None
+                columns.append([default] * len(self.positions))
+                continue
+
+            as_float = isinstance(field, ma.fields.Float)
+            columns.append(self.table.columns[attribute]
+                           .tolist(self.positions, as_float=as_float))
+        return names, columns, missing
+
+    def dicts(self, schema):
+        """The rows as dicts, like marshal(schema, rows, json=False)."""
+        names, columns, missing = self.columns(schema)
+        columns = [column for name, column in zip(names, columns)
+                   if name not in missing]
+        names = [name for name in names if name not in missing]
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def codes_of(column):
+    """The values of a column as integers that are equal where the values
+    are, with NULLs apart from everything else."""
+    if column.values.dtype.kind in "iufb":
+        return column.values
+    _, codes = np.unique(column.values.astype(str), return_inverse=True)
+    if column.mask is not None:
+        codes[column.mask] = -1
+    return codes
+
+
+def load_columnar_tables():
+    """Load all COLUMNAR_TABLES into memory for the current dataset
+    version."""
+    tables = {}
+    for model, (schema, keys) in COLUMNAR_TABLES.items():
+        fields = list(schema.Meta.fields)
+        tables[model] = ColumnarTable(model, fields, keys).load()
+
+    state = {"version": dataset_version(), "tables": tables}
+    current_app.extensions["columnar"] = state
+    return state
+
+
+def columnar_table(model):
+    """Get the in-memory copy of a table, reloading everything if the dataset
+    version has changed."""
+    state = current_app.extensions.get("columnar", None)
+    if state is None or state["version"] != dataset_version():
+        state = load_columnar_tables()
+    return state["tables"][model]
@@ -1,6 +1,8 @@
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 
+import re
+
 from atlas_core.sqlalchemy import BaseModel
 from atlas_core.model_mixins import IDMixin
 
@@ -16,9 +18,34 @@ from ..metadata.models import (product_enum, industry_enum, occupation_enum,
                                farmtype_enum, farmsize_enum, nonag_enum)
 
 
-class XProductYear(BaseModel, IDMixin):
+def index_name(table_name, columns):
+    """Name an index after its table and columns, dropping the "_id" suffixes
+    so that names stay under postgres' 63 character limit."""
+    return "{}_{}_idx".format(
+        table_name,
+        "_".join(re.sub(r"_id$", "", column) for column in columns))
+
+
+class IndexedMixin(object):
+    """Declares composite indexes for a fact table. Subclasses list tuples of
+    column names in __indexes__ and every concrete table gets one index per
+    tuple. See :py:mod:`colombia.indexes` for building and dropping them."""
+
+    __indexes__ = ()
+
+    @declared_attr
+    def __table_args__(cls):
+        return tuple(db.Index(index_name(cls.__tablename__, columns), *columns)
+                     for columns in cls.__indexes__)
+
+
+class XProductYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "level", "year"),
+        ("product_id", "year"),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -71,9 +98,13 @@ class MunicipalityProductYear(XProductYear):
     __tablename__ = "municipality_product_year"
 
 
-class ProductYear(BaseModel, IDMixin):
+class ProductYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "product_year"
+    __indexes__ = (
+        ("level", "year"),
+        ("product_id", "year"),
+    )
 
     product_id = db.Column(db.Integer, db.ForeignKey(HSProduct.id))
     year = db.Column(db.Integer)
@@ -90,9 +121,13 @@ class ProductYear(BaseModel, IDMixin):
     import_num_plants = db.Column(db.Integer)
 
 
-class CountryXProductYear(BaseModel, IDMixin):
+class CountryXProductYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "product_id", "year"),
+        ("product_id", "year"),
+    )
 
     @declared_attr
     def country_id(cls):
@@ -130,9 +165,12 @@ class CountryMunicipalityProductYear(CountryXProductYear):
     __tablename__ = "country_municipality_product_year"
 
 
-class CountryXYear(BaseModel, IDMixin):
+class CountryXYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "year"),
+    )
 
     @declared_attr
     def country_id(cls):
@@ -170,9 +208,12 @@ class CountryMunicipalityYear(CountryXYear):
     __tablename__ = "country_municipality_year"
 
 
-class PartnerProductYear(BaseModel, IDMixin):
+class PartnerProductYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "partner_product_year"
+    __indexes__ = (
+        ("product_id", "year"),
+    )
 
     country_id = db.Column(db.Integer, db.ForeignKey(Country.id))
     product_id = db.Column(db.Integer, db.ForeignKey(HSProduct.id))
@@ -189,9 +230,12 @@ class PartnerProductYear(BaseModel, IDMixin):
     import_num_plants = db.Column(db.Integer)
 
 
-class DepartmentYear(BaseModel, IDMixin):
+class DepartmentYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "department_year"
+    __indexes__ = (
+        ("location_id", "year"),
+    )
 
     location_id = db.Column(db.Integer, db.ForeignKey(Location.id))
     year = db.Column(db.Integer)
@@ -222,10 +266,19 @@ class DepartmentYear(BaseModel, IDMixin):
 
     yield_index = db.Column(db.Float)
 
+    # Totals of department_product_year, summed at import time
+    export_value = db.Column(db.BIGINT)
+    import_value = db.Column(db.BIGINT)
+    export_num_plants = db.Column(db.Integer)
+    import_num_plants = db.Column(db.Integer)
 
-class MSAYear(BaseModel, IDMixin):
+
+class MSAYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "msa_year"
+    __indexes__ = (
+        ("location_id", "year"),
+    )
 
     location_id = db.Column(db.Integer, db.ForeignKey(Location.id))
     year = db.Column(db.Integer)
@@ -243,9 +296,12 @@ class MSAYear(BaseModel, IDMixin):
     industry_eci = db.Column(db.Float)
 
 
-class MunicipalityYear(BaseModel, IDMixin):
+class MunicipalityYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "municipality_year"
+    __indexes__ = (
+        ("location_id", "year"),
+    )
 
     location_id = db.Column(db.Integer, db.ForeignKey(Location.id))
     year = db.Column(db.Integer)
@@ -256,9 +312,19 @@ class MunicipalityYear(BaseModel, IDMixin):
 
     yield_index = db.Column(db.Float)
 
-class XIndustryYear(BaseModel, IDMixin):
+    # Totals of municipality_product_year, summed at import time
+    export_value = db.Column(db.BIGINT)
+    import_value = db.Column(db.BIGINT)
+    export_num_plants = db.Column(db.Integer)
+    import_num_plants = db.Column(db.Integer)
+
+class XIndustryYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "level", "year"),
+        ("industry_id", "year"),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -301,9 +367,13 @@ class MunicipalityIndustryYear(XIndustryYear):
     __tablename__ = "municipality_industry_year"
 
 
-class IndustryYear(BaseModel, IDMixin):
+class IndustryYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "industry_year"
+    __indexes__ = (
+        ("level", "year"),
+        ("industry_id", "year"),
+    )
 
     industry_id = db.Column(db.Integer, db.ForeignKey(Industry.id))
     year = db.Column(db.Integer)
@@ -319,9 +389,13 @@ class IndustryYear(BaseModel, IDMixin):
     complexity = db.Column(db.Float)
 
 
-class OccupationYear(BaseModel, IDMixin):
+class OccupationYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "occupation_year"
+    __indexes__ = (
+        ("level",),
+        ("occupation_id",),
+    )
 
     occupation_id = db.Column(db.Integer, db.ForeignKey(Occupation.id))
     level = db.Column(occupation_enum)
@@ -332,9 +406,12 @@ class OccupationYear(BaseModel, IDMixin):
     num_vacancies = db.Column(db.Integer)
 
 
-class OccupationIndustryYear(BaseModel, IDMixin):
+class OccupationIndustryYear(BaseModel, IDMixin, IndexedMixin):
 
     __tablename__ = "occupation_industry_year"
+    __indexes__ = (
+        ("industry_id",),
+    )
 
     occupation_id = db.Column(db.Integer, db.ForeignKey(Occupation.id))
     industry_id = db.Column(db.Integer, db.ForeignKey(Industry.id))
@@ -347,9 +424,13 @@ class OccupationIndustryYear(BaseModel, IDMixin):
     num_vacancies = db.Column(db.Integer)
 
 
-class XLivestockYear(BaseModel, IDMixin):
+class XLivestockYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "livestock_level"),
+        ("livestock_id",),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -376,9 +457,13 @@ class MunicipalityLivestockYear(XLivestockYear):
     __tablename__ = "municipality_livestock_year"
 
 
-class XAgriculturalProductYear(BaseModel, IDMixin):
+class XAgriculturalProductYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "agproduct_level", "year"),
+        ("agproduct_id", "year"),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -408,9 +493,13 @@ class MunicipalityAgriculturalProductYear(XAgriculturalProductYear):
     __tablename__ = "municipality_agproduct_year"
 
 
-class XNonagYear(BaseModel, IDMixin):
+class XNonagYear(BaseModel, IDMixin, IndexedMixin):
 
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "nonag_level"),
+        ("nonag_id",),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -438,8 +527,13 @@ class MunicipalityNonagYear(XNonagYear):
 
 
 
-class XLandUseYear(BaseModel, IDMixin):
+class XLandUseYear(BaseModel, IDMixin, IndexedMixin):
+
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "land_use_level"),
+        ("land_use_id",),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -464,8 +558,13 @@ class MunicipalityLandUseYear(XLandUseYear):
     __tablename__ = "municipality_land_use_year"
 
 
-class XFarmTypeYear(BaseModel, IDMixin):
+class XFarmTypeYear(BaseModel, IDMixin, IndexedMixin):
+
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "farmtype_level"),
+        ("farmtype_id",),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -490,8 +589,13 @@ class MunicipalityFarmTypeYear(XFarmTypeYear):
     __tablename__ = "municipality_farmtype_year"
 
 
-class XFarmSizeYear(BaseModel, IDMixin):
+class XFarmSizeYear(BaseModel, IDMixin, IndexedMixin):
+
     __abstract__ = True
+    __indexes__ = (
+        ("location_id", "farmsize_level"),
+        ("farmsize_id",),
+    )
 
     @declared_attr
     def location_id(cls):
@@ -515,3 +619,34 @@ class DepartmentFarmSizeYear(XFarmSizeYear):
 class MunicipalityFarmSizeYear(XFarmSizeYear):
     __tablename__ = "municipality_farmsize_year"
 
+
+
+class DatasetVersion(BaseModel, IDMixin):
+    """A stamp written at the end of each data import. Anything derived from
+    the data, like cached responses, is keyed by the latest version so that it
+    is invalidated when new data is loaded."""
+
+    __tablename__ = "dataset_version"
+
+    version = db.Column(db.Unicode(50))
+    created_at = db.Column(db.DateTime)
+
+
+class HierarchyClosure(BaseModel, IDMixin, IndexedMixin):
+    """Transitive closure of the parent_id trees of all metadata entities: one
+    row per entity and each of its ancestors, including itself at depth 0.
+    Built at import time by :py:func:`colombia.hierarchy.build_closure`."""
+
+    __tablename__ = "hierarchy_closure"
+    __indexes__ = (
+        ("entity_type", "descendant_level", "ancestor_level"),
+    )
+
+    entity_type = db.Column(db.Unicode(25))
+
+    descendant_id = db.Column(db.Integer)
+    descendant_level = db.Column(db.Unicode(25))
+    ancestor_id = db.Column(db.Integer)
+    ancestor_level = db.Column(db.Unicode(25))
+
+    depth = db.Column(db.Integer)
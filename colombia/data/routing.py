@@ -1,10 +1,13 @@
 from ..entities import entities, metadata_apis
 from .. import models
+from ..core import db
+from ..versioning import dataset_version
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from types import MappingProxyType
 import re
 
-from flask import request
+from flask import request, current_app
 
 RANGE_RE = r"^(from|to)_(.+)$"
 
@@ -43,12 +46,75 @@ def extract_route_params(request):
     return params
 
 
+#: Read-only id -> level, id -> parent_id and id -> (child ids) mappings for
+#: one classification.
+ClassificationIndex = namedtuple("ClassificationIndex",
+                                 ["levels", "parents", "children"])
+
+
+def build_classification_index(entity_class):
+    """Load the level and parent of every entity of a Metadata subclass."""
+    assert issubclass(entity_class, models.Metadata)
+
+    levels, parents, children = {}, {}, defaultdict(list)
+    q = db.session.query(entity_class.id, entity_class.level,
+                         entity_class.parent_id)
+    for entity_id, level, parent_id in q:
+        levels[entity_id] = level
+        parents[entity_id] = parent_id
+        if parent_id is not None:
+            children[parent_id].append(entity_id)
+
+    children = {key: tuple(value) for key, value in children.items()}
+    return ClassificationIndex(MappingProxyType(levels),
+                               MappingProxyType(parents),
+                               MappingProxyType(children))
+
+
+def load_classification_indexes():
+    """Build the classification indexes for all metadata entities. This runs
+    once per worker, and again whenever the dataset version changes."""
+    state = {
+        "version": dataset_version(),
+        "indexes": {
+            entity_type: build_classification_index(settings["entity_model"])
+            for entity_type, settings in metadata_apis.items()
+        }
+    }
+    current_app.extensions["classification_indexes"] = state
+    return state
+
+
+def classification_index(entity_type):
+    """Get the :py:class:`ClassificationIndex` for an entity type, e.g.
+    "location"."""
+    state = current_app.extensions.get("classification_indexes", None)
+    if state is None or state["version"] != dataset_version():
+        state = load_classification_indexes()
+    return state["indexes"][entity_type]
+
+
 def lookup_classification_level(entity_type, entity_id):
     """Example: is this product_id a 2digit or 4digit product? Is this location
     id a department or a municipality?"""
-    entity_class = metadata_apis[entity_type]["entity_model"]
-    assert issubclass(entity_class, models.Metadata)
-    return entity_class.query.get_or_404(entity_id).level
+    level = classification_index(entity_type).levels.get(entity_id, None)
+    if level is None:
+        # Not in the index, e.g. created since the index was built. Check the
+        # database so that we still 404 properly on unknown ids.
+        entity_class = metadata_apis[entity_type]["entity_model"]
+        assert issubclass(entity_class, models.Metadata)
+        return entity_class.query.get_or_404(entity_id).level
+    return level
+
+
+def lookup_parent_id(entity_type, entity_id):
+    """Get the parent id of an entity, or None."""
+    return classification_index(entity_type).parents.get(entity_id, None)
+
+
+def lookup_children(entity_type, entity_id):
+    """Get a tuple of the ids of the entities whose parent is entity_id."""
+    return classification_index(entity_type).children.get(entity_id, ())
 
 
 def make_entity_endpoint(route):
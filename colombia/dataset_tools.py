@@ -7,6 +7,8 @@ from reckoner import assertions
 from clint.textui import puts, indent, colored
 from io import StringIO
 
+from colombia import process_cache
+
 
 def classification_to_models(classification, model):
     models = []
@@ -81,7 +83,70 @@ def bad(msg):
 indented = lambda: indent(4, quote=colored.cyan("> "))
 
 
+def aggregate_facet(df, facet_fields, aggregations):
+    """Group df by the facet fields and aggregate each column with its
+    function, e.g. mean, first, min, rank, etc. Columns whose function has an
+    aggregation attribute of "first" or "sum", like datasets.first and
+    datasets.sum_group, are done together in one pass for each of those, the
+    rest get their function called with the groupby of just that column."""
+
+    if isinstance(facet_fields, tuple):
+        facet_fields = list(facet_fields)
+    else:
+        facet_fields = [facet_fields]
+    facet_groupby = df.groupby(facet_fields)
+
+    fields = {"first": [], "sum": []}
+    for agg_field, agg_func in aggregations.items():
+        kind = getattr(agg_func, "aggregation", None)
+        if kind in fields:
+            fields[kind].append(agg_field)
+
+    agg_outputs = []
+    if fields["sum"]:
+        agg_outputs.append(facet_groupby[fields["sum"]].sum())
+    if fields["first"]:
+        # The first row of each group, nulls included, keyed like the sums
+        agg_outputs.append(df.dropna(subset=facet_fields)
+                           .drop_duplicates(facet_fields)
+                           .set_index(facet_fields)[fields["first"]]
+                           .sort_index())
+
+    for agg_field, agg_func in aggregations.items():
+        if agg_field not in fields["sum"] + fields["first"]:
+            with indented():
+                puts("Working on: {}".format(agg_field))
+            agg_outputs.append(agg_func(facet_groupby[[agg_field]]))
+
+    if len(agg_outputs) == 1:
+        facet = agg_outputs[0]
+    else:
+        facet = pd.concat(agg_outputs, axis=1)
+    return facet[list(aggregations)]
+
+
 def process_dataset(dataset):
+    """Read a dataset, clean it up and aggregate it into its facets. Returns
+    facet fields -> DataFrame. Memoized if a process cache is enabled, see
+    :py:mod:`colombia.process_cache`."""
+
+    cache = process_cache.current_cache()
+    if cache is None:
+        return _process_dataset(dataset)
+
+    key = cache.key(dataset)
+    ret = cache.get(key)
+    if ret is not None:
+        good("Reusing an already processed dataset!")
+        return ret
+
+    with process_cache.recording() as paths:
+        ret = _process_dataset(dataset)
+    cache.put(key, paths, ret)
+    return ret
+
+
+def _process_dataset(dataset):
 
     puts("=" * 80)
     good("Processing a new dataset!")
@@ -157,20 +222,8 @@ def process_dataset(dataset):
     facet_outputs = {}
     for facet_fields, aggregations in dataset["facets"].items():
         puts("Working on facet: {}".format(facet_fields))
-        facet_groupby = df.groupby(facet_fields)
-
-        # Do specified aggregations / groupings for each column
-        # like mean, first, min, rank, etc
-        agg_outputs = []
-        for agg_field, agg_func in aggregations.items():
-            with indented():
-                puts("Working on: {}".format(agg_field))
-
-            agged_row = agg_func(facet_groupby[[agg_field]])
-            agg_outputs.append(agged_row)
-
-        facet = pd.concat(agg_outputs, axis=1)
-        facet_outputs[facet_fields] = facet
+        facet_outputs[facet_fields] = aggregate_facet(df, facet_fields,
+                                                      aggregations)
 
     puts("Done! ヽ(◔◡◔)ﾉ")
 
@@ -6,6 +6,9 @@ from flask import current_app
 
 from linnaeus import classification
 
+from colombia.process_cache import record_input
+from colombia.source_cache import cached_read
+
 product_classification = classification.load("product/HS/Colombia_Prospedia/out/products_colombia_prospedia.csv")
 location_classification = classification.load("location/Colombia/Prospedia/out/locations_colombia_prosperia.csv")
 industry_classification = classification.load("industry/ISIC/Colombia_Prosperia/out/industries_colombia_isic_prosperia.csv")
@@ -26,11 +29,13 @@ country_classification.table.code = country_classification.table.code.astype(str
 def first(x):
     """Return first element of a group in a pandas GroupBy object"""
     return x.nth(0)
+first.aggregation = "first"
 
 
 def sum_group(x):
     """Get the sum for a pandas group by"""
     return x.sum()
+sum_group.aggregation = "sum"
 
 
 def null(x):
@@ -52,6 +57,7 @@ YEAR_MIN_INDUSTRY = current_app.config["YEAR_MIN_INDUSTRY"]
 YEAR_MAX_INDUSTRY = current_app.config["YEAR_MAX_INDUSTRY"]
 YEAR_MIN_AGPRODUCT = current_app.config["YEAR_MIN_AGPRODUCT"]
 YEAR_MAX_AGPRODUCT = current_app.config["YEAR_MAX_AGPRODUCT"]
+SOURCE_CACHE_DIR = current_app.config.get("SOURCE_CACHE_DIR", None)
 
 # These are MSAs (Metropolitan Statistical Area) that have a single
 # municipality associated with them - they're mostly "cities" which are munis
@@ -70,16 +76,24 @@ SINGLE_MUNI_MSAS = ['73001', '47001', '23001', '20001', '76109', '41001', '76520
 
 
 def prefix_path(to_prefix):
-    return os.path.join(DATASET_ROOT, to_prefix)
+    return record_input(os.path.join(DATASET_ROOT, to_prefix))
+
+
+def read_stata(path):
+    return cached_read(SOURCE_CACHE_DIR, pd.read_stata, path, buffered=True)
+
+
+def read_hdf(path, key):
+    return cached_read(SOURCE_CACHE_DIR, pd.read_hdf, path, key)
 
 
 def load_trade4digit_country():
-    prescriptives = pd.read_stata(prefix_path("Trade/exp_ecomplexity_rc.dta"))
+    prescriptives = read_stata(prefix_path("Trade/exp_ecomplexity_rc.dta"))
 
-    exports = pd.read_stata(prefix_path("Trade/exp_rpy_rc_p4.dta"))
+    exports = read_stata(prefix_path("Trade/exp_rpy_rc_p4.dta"))
     exports = exports.rename(columns={"X_rpy_d": "export_value",
                                       "NP_rpy": "export_num_plants"})
-    imports = pd.read_stata(prefix_path("Trade/imp_rpy_rc_p4.dta"))
+    imports = read_stata(prefix_path("Trade/imp_rpy_rc_p4.dta"))
     imports = imports.rename(columns={"X_rpy_d": "import_value",
                                       "NP_rpy": "import_num_plants"})
 
@@ -153,12 +167,12 @@ trade4digit_country = {
 
 
 def load_trade4digit_department():
-    prescriptives = pd.read_stata(prefix_path("Trade/exp_ecomplexity_r2.dta"))
+    prescriptives = read_stata(prefix_path("Trade/exp_ecomplexity_r2.dta"))
 
-    exports = pd.read_stata(prefix_path("Trade/exp_rpy_r2_p4.dta"))
+    exports = read_stata(prefix_path("Trade/exp_rpy_r2_p4.dta"))
     exports = exports.rename(columns={"X_rpy_d": "export_value",
                                       "NP_rpy": "export_num_plants"})
-    imports = pd.read_stata(prefix_path("Trade/imp_rpy_r2_p4.dta"))
+    imports = read_stata(prefix_path("Trade/imp_rpy_r2_p4.dta"))
     imports = imports.rename(columns={"X_rpy_d": "import_value",
                                       "NP_rpy": "import_num_plants"})
 
@@ -212,6 +226,10 @@ trade4digit_department = {
         ("location_id", "year"): {
             "eci": first,
             "coi": first,
+            "export_value": sum_group,
+            "import_value": sum_group,
+            "export_num_plants": sum_group,
+            "import_num_plants": sum_group
         },
         ("product_id", "year"): {
             "pci": first,
@@ -234,16 +252,16 @@ trade4digit_department = {
 
 
 def load_trade4digit_msa():
-    prescriptives = pd.read_stata(prefix_path("Trade/exp_ecomplexity_rcity.dta"))
+    prescriptives = read_stata(prefix_path("Trade/exp_ecomplexity_rcity.dta"))
 
     # Fix certain muni codes to msa codes, see MEX-148
     is_single_muni_msa = prescriptives.r.isin(SINGLE_MUNI_MSAS)
     prescriptives.loc[is_single_muni_msa, "r"] = prescriptives.loc[is_single_muni_msa, "r"].map(lambda x: x + "0")
 
-    exports = pd.read_stata(prefix_path("Trade/exp_rpy_ra_p4.dta"))
+    exports = read_stata(prefix_path("Trade/exp_rpy_ra_p4.dta"))
 
     # Add missing exports from single muni MSAs. See MEX-148
-    muni_exports = pd.read_stata(prefix_path("Trade/exp_rpy_r5_p4.dta"))
+    muni_exports = read_stata(prefix_path("Trade/exp_rpy_r5_p4.dta"))
     muni_exports = muni_exports[muni_exports.r.isin(SINGLE_MUNI_MSAS)]
     muni_exports.r = muni_exports.r.map(lambda x: x + "0")
     exports = pd.concat([exports, muni_exports]).reset_index(drop=True)
@@ -251,10 +269,10 @@ def load_trade4digit_msa():
     exports = exports.rename(columns={"X_rpy_d": "export_value",
                                       "NP_rpy": "export_num_plants"})
 
-    imports = pd.read_stata(prefix_path("Trade/imp_rpy_ra_p4.dta"))
+    imports = read_stata(prefix_path("Trade/imp_rpy_ra_p4.dta"))
 
     # Add missing imports from single muni MSAs. See MEX-148
-    muni_imports = pd.read_stata(prefix_path("Trade/imp_rpy_r5_p4.dta"))
+    muni_imports = read_stata(prefix_path("Trade/imp_rpy_r5_p4.dta"))
     muni_imports = muni_imports[muni_imports.r.isin(SINGLE_MUNI_MSAS)]
     muni_imports.r = muni_imports.r.map(lambda x: x + "0")
     imports = pd.concat([imports, muni_imports]).reset_index(drop=True)
@@ -330,10 +348,10 @@ trade4digit_msa = {
 
 
 def load_trade4digit_municipality():
-    exports = pd.read_stata(prefix_path("Trade/exp_rpy_r5_p4.dta"))
+    exports = read_stata(prefix_path("Trade/exp_rpy_r5_p4.dta"))
     exports = exports.rename(columns={"X_rpy_d": "export_value",
                                       "NP_rpy": "export_num_plants"})
-    imports = pd.read_stata(prefix_path("Trade/imp_rpy_r5_p4.dta"))
+    imports = read_stata(prefix_path("Trade/imp_rpy_r5_p4.dta"))
     imports = imports.rename(columns={"X_rpy_d": "import_value",
                                       "NP_rpy": "import_num_plants"})
 
@@ -375,6 +393,12 @@ trade4digit_municipality = {
     },
     "facet_fields": ["location", "product", "year"],
     "facets": {
+        ("location_id", "year"): {
+            "export_value": sum_group,
+            "export_num_plants": sum_group,
+            "import_value": sum_group,
+            "import_num_plants": sum_group
+        },
         ("location_id", "product_id", "year"): {
             "export_value": first,
             "export_num_plants": first,
@@ -398,11 +422,9 @@ trade4digit_rcpy_fields_export = {
 
 
 def read_trade4digit_rcpy(suffix="rc_p4"):
-    e = pd\
-        .read_stata(prefix_path("Trade/exp_rcpy_{}.dta".format(suffix)))\
+    e = read_stata(prefix_path("Trade/exp_rcpy_{}.dta".format(suffix)))\
         .rename(columns={"ctry_dest": "country"})
-    i = pd\
-        .read_stata(prefix_path("Trade/imp_rcpy_{}.dta".format(suffix)))\
+    i = read_stata(prefix_path("Trade/imp_rcpy_{}.dta".format(suffix)))\
         .rename(columns={"ctry_orig": "country"})
     df = e.merge(i,
                  on=['r', 'p', 'country', 'yr'],
@@ -599,7 +621,7 @@ def hook_industry(df):
 
 
 def industry4digit_country_read():
-    df = pd.read_hdf(prefix_path("Industries/industries_all.hdf"), "data")
+    df = read_hdf(prefix_path("Industries/industries_all.hdf"), "data")
     df["country_code"] = "COL"
     return df
 
@@ -645,7 +667,7 @@ industry4digit_country = {
 }
 
 industry4digit_department = {
-    "read_function": lambda: pd.read_hdf(prefix_path("Industries/industries_state.hdf"), "data"),
+    "read_function": lambda: read_hdf(prefix_path("Industries/industries_state.hdf"), "data"),
     "field_mapping": {
         "state_code": "location",
         "p_code": "industry",
@@ -712,7 +734,7 @@ def hook_industry4digit_msa(df):
     return df
 
 industry4digit_msa = {
-    "read_function": lambda: pd.read_hdf(prefix_path("Industries/industries_msa.hdf"), "data"),
+    "read_function": lambda: read_hdf(prefix_path("Industries/industries_msa.hdf"), "data"),
     "hook_pre_merge": hook_industry4digit_msa,
     "field_mapping": {
         "msa_code": "location",
@@ -770,7 +792,7 @@ industry4digit_msa = {
 }
 
 industry4digit_municipality = {
-    "read_function": lambda: pd.read_hdf(prefix_path("Industries/industries_muni.hdf"), "data"),
+    "read_function": lambda: read_hdf(prefix_path("Industries/industries_muni.hdf"), "data"),
     "hook_pre_merge": hook_industry,
     "field_mapping": {
         "muni_code": "location",
@@ -807,7 +829,7 @@ industry4digit_municipality = {
 }
 
 population = {
-    "read_function": lambda: pd.read_stata(prefix_path("Final_Metadata/col_pop_muni_dept_natl.dta")),
+    "read_function": lambda: read_stata(prefix_path("Final_Metadata/col_pop_muni_dept_natl.dta")),
     "hook_pre_merge": lambda df: df[~df[["location", "year", "population"]].duplicated()],
     "field_mapping": {
         "year": "year",
@@ -833,7 +855,7 @@ population = {
 
 
 gdp_nominal_department = {
-    "read_function": lambda: pd.read_stata(prefix_path("Final_Metadata/col_nomgdp_muni_dept_natl.dta")),
+    "read_function": lambda: read_stata(prefix_path("Final_Metadata/col_nomgdp_muni_dept_natl.dta")),
     "hook_pre_merge": lambda df: df.drop_duplicates(["location", "year"]),
     "field_mapping": {
         "dept_code": "location",
@@ -859,7 +881,7 @@ gdp_nominal_department = {
 
 
 gdp_real_department = {
-    "read_function": lambda: pd.read_stata(prefix_path("Final_Metadata/col_realgdp_dept_natl.dta")),
+    "read_function": lambda: read_stata(prefix_path("Final_Metadata/col_realgdp_dept_natl.dta")),
     "field_mapping": {
         "dept_code": "location",
         "real_gdp": "gdp_real",
@@ -884,7 +906,7 @@ gdp_real_department = {
 
 
 def industry2digit_country_read():
-    df = pd.read_hdf(prefix_path("Industries/industries_all.hdf"), "data")
+    df = read_hdf(prefix_path("Industries/industries_all.hdf"), "data")
     df["country_code"] = "COL"
     return df
 
@@ -928,7 +950,7 @@ industry2digit_country = {
 }
 
 industry2digit_department = {
-    "read_function": lambda: pd.read_hdf(prefix_path("Industries/industries_state.hdf"), "data"),
+    "read_function": lambda: read_hdf(prefix_path("Industries/industries_state.hdf"), "data"),
     "hook_pre_merge": hook_industry,
     "field_mapping": {
         "state_code": "location",
@@ -978,7 +1000,7 @@ def hook_industry2digit_msa(df):
     return df
 
 industry2digit_msa = {
-    "read_function": lambda: pd.read_hdf(prefix_path("Industries/industries_msa.hdf"), "data"),
+    "read_function": lambda: read_hdf(prefix_path("Industries/industries_msa.hdf"), "data"),
     "hook_pre_merge": hook_industry2digit_msa,
     "field_mapping": {
         "msa_code": "location",
@@ -1030,7 +1052,7 @@ industry2digit_msa = {
 }
 
 occupation2digit_industry2digit = {
-    "read_function": lambda: pd.read_stata(prefix_path("Vacancies/Vacancies_do130_2d-Ind_X_4d-Occ.dta")),
+    "read_function": lambda: read_stata(prefix_path("Vacancies/Vacancies_do130_2d-Ind_X_4d-Occ.dta")),
     "field_mapping": {
         "onet_4dig": "occupation",
         "ciiu_2dig": "industry",
@@ -1061,7 +1083,7 @@ occupation2digit_industry2digit = {
 }
 
 occupation2digit = {
-    "read_function": lambda: pd.read_stata(prefix_path("Vacancies/Vacancies_do140_4d-Occ.dta")),
+    "read_function": lambda: read_stata(prefix_path("Vacancies/Vacancies_do140_4d-Occ.dta")),
     "field_mapping": {
         "onet_4dig": "occupation",
         "num_vacantes": "num_vacancies",
@@ -1125,7 +1147,7 @@ livestock_template = {
 }
 
 def read_livestock_level1_country():
-    df = pd.read_stata(prefix_path("Rural/livestock_Col_2.dta"))
+    df = read_stata(prefix_path("Rural/livestock_Col_2.dta"))
     df["location_id"] = "COL"
     return df
 
@@ -1142,14 +1164,14 @@ livestock_level1_country["digit_padding"]["location"] = 3
 
 
 livestock_level1_department = copy.deepcopy(livestock_template)
-livestock_level1_department["read_function"] = lambda: pd.read_stata(prefix_path("Rural/livestock_dept_2.dta"))
+livestock_level1_department["read_function"] = lambda: read_stata(prefix_path("Rural/livestock_dept_2.dta"))
 livestock_level1_department["hook_pre_merge"] = hook_livestock
 livestock_level1_department["classification_fields"]["location"]["level"] = "department"
 livestock_level1_department["digit_padding"]["location"] = 2
 
 
 livestock_level1_municipality = copy.deepcopy(livestock_template)
-livestock_level1_municipality["read_function"] = lambda: pd.read_stata(prefix_path("Rural/livestock_muni_2.dta"))
+livestock_level1_municipality["read_function"] = lambda: read_stata(prefix_path("Rural/livestock_muni_2.dta"))
 livestock_level1_municipality["hook_pre_merge"] = hook_livestock
 livestock_level1_municipality["classification_fields"]["location"]["level"] = "municipality"
 livestock_level1_municipality["digit_padding"]["location"] = 5
@@ -1197,7 +1219,7 @@ agproduct_template = {
 
 
 def read_agproduct_level3_country():
-    df = pd.read_stata(prefix_path("Rural/agric_2007_2015_Col_final_2.dta"))
+    df = read_stata(prefix_path("Rural/agric_2007_2015_Col_final_2.dta"))
     df["location_id"] = "COL"
     return df
 
@@ -1216,13 +1238,13 @@ agproduct_level3_country["classification_fields"]["location"]["level"] = "countr
 agproduct_level3_country["digit_padding"]["location"] = 3
 
 agproduct_level3_department = copy.deepcopy(agproduct_template)
-agproduct_level3_department["read_function"] = lambda: pd.read_stata(prefix_path("Rural/agric_2007_2015_dept_final_2.dta"))
+agproduct_level3_department["read_function"] = lambda: read_stata(prefix_path("Rural/agric_2007_2015_dept_final_2.dta"))
 agproduct_level3_department["hook_pre_merge"] = hook_agproduct
 agproduct_level3_department["classification_fields"]["location"]["level"] = "department"
 agproduct_level3_department["digit_padding"]["location"] = 2
 
 agproduct_level3_municipality = copy.deepcopy(agproduct_template)
-agproduct_level3_municipality["read_function"] = lambda: pd.read_stata(prefix_path("Rural/agric_2007_2015_muni_final_2.dta"))
+agproduct_level3_municipality["read_function"] = lambda: read_stata(prefix_path("Rural/agric_2007_2015_muni_final_2.dta"))
 agproduct_level3_municipality["hook_pre_merge"] = hook_agproduct
 agproduct_level3_municipality["classification_fields"]["location"]["level"] = "municipality"
 agproduct_level3_municipality["digit_padding"]["location"] = 3
@@ -1265,7 +1287,7 @@ land_use_template = {
 }
 
 def read_land_use_level2_country():
-    df = pd.read_stata(prefix_path("Rural/land_use_Col_c.dta"))
+    df = read_stata(prefix_path("Rural/land_use_Col_c.dta"))
     df["location_id"] = "COL"
     return df
 
@@ -1276,13 +1298,13 @@ land_use_level2_country["digit_padding"]["location"] = 3
 
 
 land_use_level2_department = copy.deepcopy(land_use_template)
-land_use_level2_department["read_function"] = lambda: pd.read_stata(prefix_path("Rural/land_use_dept_c.dta"))
+land_use_level2_department["read_function"] = lambda: read_stata(prefix_path("Rural/land_use_dept_c.dta"))
 land_use_level2_department["classification_fields"]["location"]["level"] = "department"
 land_use_level2_department["digit_padding"]["location"] = 2
 
 
 land_use_level2_municipality = copy.deepcopy(land_use_template)
-land_use_level2_municipality["read_function"] = lambda: pd.read_stata(prefix_path("Rural/land_use_muni_c.dta"))
+land_use_level2_municipality["read_function"] = lambda: read_stata(prefix_path("Rural/land_use_muni_c.dta"))
 land_use_level2_municipality["hook_pre_merge"] = hook_land_use
 land_use_level2_municipality["classification_fields"]["location"]["level"] = "municipality"
 land_use_level2_municipality["digit_padding"]["location"] = 5
@@ -1324,7 +1346,7 @@ farmtype_template = {
 }
 
 def read_farmtype_level2_country():
-    df = pd.read_stata(prefix_path("Rural/farms_Col_c.dta"))
+    df = read_stata(prefix_path("Rural/farms_Col_c.dta"))
     df["location_id"] = "COL"
     return df
 
@@ -1335,13 +1357,13 @@ farmtype_level2_country["digit_padding"]["location"] = 3
 
 
 farmtype_level2_department = copy.deepcopy(farmtype_template)
-farmtype_level2_department["read_function"] = lambda: pd.read_stata(prefix_path("Rural/farms_dept_c.dta"))
+farmtype_level2_department["read_function"] = lambda: read_stata(prefix_path("Rural/farms_dept_c.dta"))
 farmtype_level2_department["classification_fields"]["location"]["level"] = "department"
 farmtype_level2_department["digit_padding"]["location"] = 2
 
 
 farmtype_level2_municipality = copy.deepcopy(farmtype_template)
-farmtype_level2_municipality["read_function"] = lambda: pd.read_stata(prefix_path("Rural/farms_muni_c.dta"))
+farmtype_level2_municipality["read_function"] = lambda: read_stata(prefix_path("Rural/farms_muni_c.dta"))
 farmtype_level2_municipality["hook_pre_merge"] = hook_farmtype
 farmtype_level2_municipality["classification_fields"]["location"]["level"] = "municipality"
 farmtype_level2_municipality["digit_padding"]["location"] = 5
@@ -1383,7 +1405,7 @@ farmsize_template = {
 }
 
 def read_farmsize_level1_country():
-    df = pd.read_stata(prefix_path("Rural/average_farms_size_Col.dta"))
+    df = read_stata(prefix_path("Rural/average_farms_size_Col.dta"))
     df["location_id"] = "COL"
     return df
 
@@ -1394,13 +1416,13 @@ farmsize_level1_country["digit_padding"]["location"] = 3
 
 
 farmsize_level1_department = copy.deepcopy(farmsize_template)
-farmsize_level1_department["read_function"] = lambda: pd.read_stata(prefix_path("Rural/average_farms_size_dept.dta"))
+farmsize_level1_department["read_function"] = lambda: read_stata(prefix_path("Rural/average_farms_size_dept.dta"))
 farmsize_level1_department["classification_fields"]["location"]["level"] = "department"
 farmsize_level1_department["digit_padding"]["location"] = 2
 
 
 farmsize_level1_municipality = copy.deepcopy(farmsize_template)
-farmsize_level1_municipality["read_function"] = lambda: pd.read_stata(prefix_path("Rural/average_farms_size_muni.dta"))
+farmsize_level1_municipality["read_function"] = lambda: read_stata(prefix_path("Rural/average_farms_size_muni.dta"))
 farmsize_level1_municipality["hook_pre_merge"] = hook_farmsize
 farmsize_level1_municipality["classification_fields"]["location"]["level"] = "municipality"
 farmsize_level1_municipality["digit_padding"]["location"] = 5
@@ -1458,7 +1480,7 @@ def fix_nonagric(df):
     return df
 
 def read_nonagric_level3_country():
-    df = pd.read_stata(prefix_path("Rural/non_agri_activities_Col.dta"))
+    df = read_stata(prefix_path("Rural/non_agri_activities_Col.dta"))
     df["location_id"] = "COL"
 
     df["activity_name"] = df["activities"].str.strip()
@@ -1470,13 +1492,13 @@ def read_nonagric_level3_country():
 
 
 def read_nonagric_level3_department():
-    df = pd.read_stata(prefix_path("Rural/non_agri_activities_dept.dta"))
+    df = read_stata(prefix_path("Rural/non_agri_activities_dept.dta"))
     df = fix_nonagric(df)
     return df
 
 
 def read_nonagric_level3_municipality():
-    df = pd.read_stata(prefix_path("Rural/non_agri_activities_muni.dta"))
+    df = read_stata(prefix_path("Rural/non_agri_activities_muni.dta"))
     df = fix_nonagric(df)
     return df
 
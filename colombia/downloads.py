@@ -1,4 +1,5 @@
 from colombia import create_app
+from colombia.process_cache import enable_from_config
 from dataset_tools import process_dataset, merge_classification_by_id
 
 from unidecode import unidecode
@@ -335,6 +336,9 @@ if __name__ == "__main__":
     app = create_app()
     with app.app_context():
 
+        # trade4digit_country is used by several of the files
+        enable_from_config(app.config)
+
         from datasets import (
             trade4digit_country, trade4digit_department,
             trade4digit_msa, trade4digit_municipality,
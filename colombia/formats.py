@@ -0,0 +1,92 @@
+"""Binary wire formats for bulk consumers of the data API. Clients that send
+an Accept header asking for MessagePack or an Arrow IPC stream get the same
+rows as the json response, encoded in that format instead:
+
+- MessagePack: {"data": [row, ...]}, exactly like the json.
+- Arrow: one record batch stream, with one column per field.
+
+Both are optional, see requirements-optimizations.txt. Formats whose library
+isn't installed are never offered."""
+
+from functools import lru_cache
+
+from flask import current_app, request
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+
+
+@lru_cache(maxsize=None)
+def _installed(module_name):
+    try:
+        __import__(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def available_mimetypes():
+    """The mimetypes we can respond with, json first so that it wins ties."""
+    mimetypes = [JSON]
+    if _installed("msgpack"):
+        mimetypes.append(MSGPACK)
+    if _installed("pyarrow"):
+        mimetypes.append(ARROW)
+    return mimetypes
+
+
+def negotiate():
+    """Pick the response mimetype based on the Accept header. Defaults to
+    json."""
+    return request.accept_mimetypes.best_match(available_mimetypes(),
+                                               default=JSON)
+
+
+def encode_msgpack(names, rows):
+    import msgpack
+    data = [dict(zip(names, row)) for row in rows]
+    return msgpack.packb({"data": data}, use_bin_type=True)
+
+
+def encode_arrow(names, rows):
+    if len(rows) == 0:
+        columns = [[] for name in names]
+    else:
+        columns = [list(values) for values in zip(*rows)]
+    return encode_arrow_columns(names, columns)
+
+
+def encode_arrow_columns(names, columns):
+    import pyarrow as pa
+    table = pa.Table.from_arrays([pa.array(values) for values in columns],
+                                 names=list(names))
+
+    sink = pa.BufferOutputStream()
+    writer = pa.ipc.new_stream(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+ENCODERS = {
+    MSGPACK: encode_msgpack,
+    ARROW: encode_arrow,
+}
+
+
+def binary_response(mimetype, names, rows):
+    """Make a response in the given binary format out of a list of value
+    tuples in the order of names."""
+    body = ENCODERS[mimetype](names, rows)
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+def binary_columns_response(mimetype, names, columns):
+    """Like :py:func:`binary_response`, but out of a list of values for each
+    name. Arrow is encoded from those directly."""
+    if mimetype == ARROW:
+        body = encode_arrow_columns(names, columns)
+    else:
+        body = ENCODERS[mimetype](names, list(zip(*columns)))
+    return current_app.response_class(body, mimetype=mimetype)
@@ -0,0 +1,65 @@
+"""The hierarchy closure table maps every metadata entity to all of its
+ancestors, e.g. each 4digit product to its 2digit product and its section.
+Mapping entities from any classification level to any higher one is then a
+single indexed lookup instead of one self-join per level in between.
+
+:py:mod:`colombia.import` builds it after loading the classifications."""
+
+from .core import db
+from .data.models import HierarchyClosure
+from .data.routing import build_classification_index
+from .entities import metadata_apis
+
+
+def closure_rows(entity_type, levels, parents):
+    """Yield a closure table row for each entity in an id -> level and id ->
+    parent_id mapping and each of its ancestors, starting with itself."""
+    for entity_id, level in levels.items():
+        ancestor_id, depth = entity_id, 0
+        seen = set()
+        while ancestor_id in levels and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            yield {
+                "entity_type": entity_type,
+                "descendant_id": entity_id,
+                "descendant_level": level,
+                "ancestor_id": ancestor_id,
+                "ancestor_level": levels[ancestor_id],
+                "depth": depth,
+            }
+            ancestor_id = parents.get(ancestor_id, None)
+            depth += 1
+
+
+def build_closure(entity_types=None, chunk_size=10000):
+    """(Re)build the closure table rows for the given entity types, by default
+    all of them. Returns the number of rows inserted."""
+    if entity_types is None:
+        entity_types = sorted(metadata_apis.keys())
+
+    table = HierarchyClosure.__table__
+    num_rows = 0
+    for entity_type in entity_types:
+        index = build_classification_index(
+            metadata_apis[entity_type]["entity_model"])
+
+        db.session.execute(
+            table.delete().where(table.c.entity_type == entity_type))
+
+        rows = list(closure_rows(entity_type, index.levels, index.parents))
+        for i in range(0, len(rows), chunk_size):
+            db.session.execute(table.insert(), rows[i:i + chunk_size])
+        num_rows += len(rows)
+
+    db.session.commit()
+    return num_rows
+
+
+def ancestors(entity_type, from_level, to_level):
+    """Query (descendant_id, ancestor_id) pairs mapping entities at from_level
+    to their ancestor at to_level."""
+    return db.session\
+        .query(HierarchyClosure.descendant_id, HierarchyClosure.ancestor_id)\
+        .filter_by(entity_type=entity_type,
+                   descendant_level=from_level,
+                   ancestor_level=to_level)
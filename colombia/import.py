@@ -1,8 +1,17 @@
 from colombia import models, create_app
 from colombia.core import db
+from colombia.indexes import drop_indexes, build_indexes
+from colombia.versioning import stamp_dataset_version
+from colombia.snapshots import SnapshotStore, render_snapshots
+from colombia.hierarchy import build_closure
+from colombia.rollups import write_rollups
+from colombia.bulkload import bulk_load, format_stats
+from colombia.scheduler import Task, run_graph
+from colombia.process_cache import enable_from_config
 
 from dataset_tools import (process_dataset, classification_to_models)
 
+from flask import current_app
 import pandas as pd
 import numpy as np
 
@@ -22,38 +31,409 @@ def weighted_mean(data_field, weights_field):
     return inner
 
 
+def filter_year_range(df, min_year, max_year):
+    return df[(min_year <= df.year) & (df.year <= max_year)]
+
+
+def load_table(df, table_name):
+    print(format_stats(bulk_load(df, table_name)))
+
+
+# The import is a graph of tasks. Most of them load one dataset from
+# datasets.py and write some of its facets to tables, those are described
+# in IMPORT_DATASETS:
+#
+#   dataset name -> {
+#       "tables": [{
+#           "facet": facet to write,
+#           "table": table to append it to,
+#           "columns": {column: value} to add, e.g. the classification level,
+#           "rollup": entity type to roll up, see colombia.rollups,
+#           "rollup_levels": levels to roll up to, if not all higher ones,
+#       }, ...],
+#       "returns": facets that other tasks need,
+#   }
+#
+# The rest, like department_year, merge facets of several datasets and are
+# listed with their dependencies in import_tasks().
+
+IMPORT_DATASETS = {
+    "trade4digit_country": {
+        "tables": [{
+            "facet": ("location_id", "product_id", "year"),
+            "table": "country_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+    },
+    "trade4digit_department": {
+        "tables": [{
+            "facet": ("product_id", "year"),
+            "table": "product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }, {
+            "facet": ("location_id", "product_id", "year"),
+            "table": "department_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+        "returns": [("location_id", "year")],
+    },
+    "trade4digit_municipality": {
+        "tables": [{
+            "facet": ("location_id", "product_id", "year"),
+            "table": "municipality_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+        "returns": [("location_id", "year")],
+    },
+    "trade4digit_msa": {
+        "tables": [{
+            "facet": ("location_id", "product_id", "year"),
+            "table": "msa_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+        "returns": [("location_id", "year")],
+    },
+    "trade4digit_rcpy_country": {
+        "tables": [{
+            "facet": ("country_id", "location_id", "year"),
+            "table": "country_country_year",
+        }, {
+            "facet": ("product_id", "country_id", "year"),
+            "table": "partner_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+    },
+    "trade4digit_rcpy_msa": {
+        "tables": [{
+            "facet": ("country_id", "location_id", "year"),
+            "table": "country_msa_year",
+        }],
+    },
+    "trade4digit_rcpy_municipality": {
+        "tables": [{
+            "facet": ("country_id", "location_id", "year"),
+            "table": "country_municipality_year",
+        }, {
+            "facet": ("country_id", "location_id", "product_id", "year"),
+            "table": "country_municipality_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }],
+    },
+    "trade4digit_rcpy_department": {
+        "tables": [{
+            "facet": ("country_id", "location_id", "product_id", "year"),
+            "table": "country_department_product_year",
+            "columns": {"level": "4digit"},
+            "rollup": "product",
+        }, {
+            "facet": ("country_id", "location_id", "year"),
+            "table": "country_department_year",
+        }],
+    },
+    "industry4digit_country": {
+        "tables": [{
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "country_industry_year",
+            "columns": {"level": "class"},
+            "rollup": "industry",
+        }],
+    },
+    # Division level data comes from the 2digit datasets, so the 4digit ones
+    # of the same tables are only rolled up to group and section
+    "industry4digit_department": {
+        "tables": [{
+            "facet": ("industry_id", "year"),
+            "table": "industry_year",
+            "columns": {"level": "class"},
+            "rollup": "industry",
+            "rollup_levels": ["group", "section"],
+        }, {
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "department_industry_year",
+            "columns": {"level": "class"},
+            "rollup": "industry",
+            "rollup_levels": ["group", "section"],
+        }],
+        "returns": [("location_id", "year")],
+    },
+    "industry4digit_msa": {
+        "tables": [{
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "msa_industry_year",
+            "columns": {"level": "class"},
+            "rollup": "industry",
+            "rollup_levels": ["group", "section"],
+        }],
+        "returns": [("location_id", "year")],
+    },
+    "industry4digit_municipality": {
+        "tables": [{
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "municipality_industry_year",
+            "columns": {"level": "class"},
+            "rollup": "industry",
+        }],
+    },
+    "industry2digit_country": {
+        "tables": [{
+            "facet": ("industry_id", "year"),
+            "table": "industry_year",
+            "columns": {"level": "division"},
+        }],
+    },
+    "industry2digit_department": {
+        "tables": [{
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "department_industry_year",
+            "columns": {"level": "division"},
+        }],
+    },
+    "industry2digit_msa": {
+        "tables": [{
+            "facet": ("location_id", "industry_id", "year"),
+            "table": "msa_industry_year",
+            "columns": {"level": "division"},
+        }],
+    },
+    "gdp_real_department": {
+        "returns": [("location_id", "year")],
+    },
+    "gdp_nominal_department": {
+        "returns": [("location_id", "year")],
+    },
+    "population": {
+        "returns": [("location_id", "year")],
+    },
+    "occupation2digit": {
+        "tables": [{
+            "facet": "occupation_id",
+            "table": "occupation_year",
+            "columns": {"level": "minor_group"},
+        }],
+    },
+    "occupation2digit_industry2digit": {
+        "tables": [{
+            "facet": ("occupation_id", "industry_id"),
+            "table": "occupation_industry_year",
+            "columns": {"level": "minor_group"},
+        }],
+    },
+}
+
+for level in ["country", "department", "municipality"]:
+    IMPORT_DATASETS["livestock_level1_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "livestock_id"),
+            "table": level + "_livestock_year",
+            "columns": {"livestock_level": "level1"},
+            "rollup": "livestock",
+        }],
+        "returns": [("location_id",)],
+    }
+    IMPORT_DATASETS["agproduct_level3_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "agproduct_id", "year"),
+            "table": level + "_agproduct_year",
+            "columns": {"agproduct_level": "level3"},
+            "rollup": "agproduct",
+        }],
+        "returns": [("location_id", "agproduct_id", "year")],
+    }
+    IMPORT_DATASETS["nonagric_level3_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "nonag_id"),
+            "table": level + "_nonag_year",
+            "columns": {"nonag_level": "level3"},
+        }],
+    }
+    IMPORT_DATASETS["land_use_level2_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "land_use_id"),
+            "table": level + "_land_use_year",
+            "columns": {"land_use_level": "level2"},
+            "rollup": "land_use",
+        }],
+    }
+    IMPORT_DATASETS["farmtype_level2_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "farmtype_id"),
+            "table": level + "_farmtype_year",
+            "columns": {"farmtype_level": "level2"},
+            "rollup": "farmtype",
+        }],
+    }
+    IMPORT_DATASETS["farmsize_level1_" + level] = {
+        "tables": [{
+            "facet": ("location_id", "farmsize_id"),
+            "table": level + "_farmsize_year",
+            "columns": {"farmsize_level": "level1"},
+        }],
+    }
+
+
+def load_dataset(name, inputs):
+    """Process a dataset, write the facets listed in IMPORT_DATASETS to their
+    tables and return the ones other tasks need."""
+    import datasets
+
+    settings = IMPORT_DATASETS[name]
+    ret = process_dataset(getattr(datasets, name))
+
+    for target in settings.get("tables", []):
+        df = ret[target["facet"]].reset_index()
+        for column, value in target.get("columns", {}).items():
+            df[column] = value
+        load_table(df, target["table"])
+        if "rollup" in target:
+            print(format_stats(write_rollups(
+                df, target["table"], target["rollup"],
+                target.get("rollup_levels", None))))
+
+    return {facet: ret[facet] for facet in settings.get("returns", [])}
+
+
+def livestock_load(ret):
+    """Average livestock per farm by location, from a livestock dataset."""
+    df = ret[('location_id',)].reset_index()
+    df["average_livestock_load"] = df.num_livestock / df.num_farms
+    return df
+
+
+def yield_index(ret):
+    """Yield index by location and year, from an agproduct dataset."""
+    df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
+    df = df\
+        .groupby(["location_id", "year"])\
+        .apply(weighted_mean("yield_index", "land_harvested"))
+    df.name = "yield_index"
+    return df.reset_index()
+
+
+def load_livestock_year(inputs):
+    df = livestock_load(inputs["livestock_level1_department"])
+    df = df.drop(["num_livestock", "num_farms"], axis=1)
+    df["livestock_level"] = "level1"
+    load_table(df, "livestock_year")
+
+
+def load_department_year(inputs):
+    """Merge all dept-year variables together."""
+    c = current_app.config
+
+    dy_p = inputs["trade4digit_department"][('location_id', 'year')]\
+        .reset_index()
+    dy_i = inputs["industry4digit_department"][('location_id', 'year')]\
+        .reset_index()
+
+    gdp_real_df = inputs["gdp_real_department"][('location_id', 'year')]
+    gdp_nominal_df = inputs["gdp_nominal_department"][('location_id', 'year')]
+    gdp_df = gdp_real_df.join(gdp_nominal_df).reset_index()
+
+    pop_df = inputs["population"][('location_id', 'year')].reset_index()
+
+    ls_df = livestock_load(inputs["livestock_level1_department"])
+    ls_df["year"] = c["YEAR_AGRICULTURAL_CENSUS"]
+    ls_df = ls_df[["location_id", "average_livestock_load", "year"]]
+
+    agproduct_df = yield_index(inputs["agproduct_level3_department"])
+
+    gdp_df = filter_year_range(gdp_df, c["YEAR_MIN_DEMOGRAPHIC"], c["YEAR_MAX_DEMOGRAPHIC"])
+    pop_df = filter_year_range(pop_df, c["YEAR_MIN_DEMOGRAPHIC"], c["YEAR_MAX_DEMOGRAPHIC"])
+    ls_df = filter_year_range(ls_df, c["YEAR_AGRICULTURAL_CENSUS"], c["YEAR_AGRICULTURAL_CENSUS"])
+    agproduct_df = filter_year_range(agproduct_df, c["YEAR_MIN_AGPRODUCT"], c["YEAR_MAX_AGPRODUCT"])
+
+    dy = dy_p.merge(dy_i, on=["location_id", "year"], how="outer")
+    dy = dy.merge(gdp_df, on=["location_id", "year"], how="outer")
+    dy = dy.merge(pop_df, on=["location_id", "year"], how="outer")
+    dy = dy.merge(ls_df, on=["location_id", "year"], how="left")
+    dy = dy.merge(agproduct_df, on=["location_id", "year"], how="left")
+
+    dy["gdp_pc_nominal"] = dy.gdp_nominal / dy.population
+    dy["gdp_pc_real"] = dy.gdp_real / dy.population
+
+    load_table(dy, "department_year")
+
+
+def load_municipality_year(inputs):
+    c = current_app.config
+
+    ls_df = livestock_load(inputs["livestock_level1_municipality"])
+    ls_df["year"] = c["YEAR_AGRICULTURAL_CENSUS"]
+    ls_df = ls_df[["location_id", "average_livestock_load", "year"]]
+
+    agproduct_df = yield_index(inputs["agproduct_level3_municipality"])
+
+    trade_municipality_year = \
+        inputs["trade4digit_municipality"][('location_id', 'year')]\
+        .reset_index()
+
+    my = ls_df.merge(agproduct_df, on=["location_id", "year"], how="outer")
+    my = my.merge(trade_municipality_year, on=["location_id", "year"], how="outer")
+    load_table(my, "municipality_year")
+
+
+def load_msa_year(inputs):
+    industry_msa_year = inputs["industry4digit_msa"][('location_id', 'year')]
+    trade_msa_year = inputs["trade4digit_msa"][('location_id', 'year')]
+    msa_year = industry_msa_year.join(trade_msa_year).reset_index()
+    load_table(msa_year, "msa_year")
+
+
+def import_tasks():
+    """The whole import as a graph of :py:class:`~colombia.scheduler.Task`."""
+    tasks = {name: Task(load_dataset, (name,), ())
+             for name in IMPORT_DATASETS}
+    tasks.update({
+        "livestock_year": Task(load_livestock_year, (), (
+            "livestock_level1_department",
+        )),
+        "department_year": Task(load_department_year, (), (
+            "trade4digit_department", "industry4digit_department",
+            "gdp_real_department", "gdp_nominal_department", "population",
+            "livestock_level1_department", "agproduct_level3_department",
+        )),
+        "municipality_year": Task(load_municipality_year, (), (
+            "trade4digit_municipality", "livestock_level1_municipality",
+            "agproduct_level3_municipality",
+        )),
+        "msa_year": Task(load_msa_year, (), (
+            "trade4digit_msa", "industry4digit_msa",
+        )),
+    })
+    return tasks
+
+
+def init_worker():
+    """Give each import worker process an app context of its own, and make
+    sure it doesn't share database connections with the parent."""
+    app = create_app()
+    app.app_context().push()
+    db.engine.dispose()
+    enable_from_config(app.config)
+
+
+def import_workers():
+    """How many processes to import with, IMPORT_WORKERS or one per core.
+    sqlite only allows one writer at a time, so it always gets one."""
+    if db.engine.dialect.name == "sqlite":
+        return 1
+    return current_app.config.get("IMPORT_WORKERS", None)
+
+
 if __name__ == "__main__":
 
         app = create_app()
         with app.app_context():
 
             c = app.config
-
-            from datasets import (
-                trade4digit_country, trade4digit_department,
-                trade4digit_msa, trade4digit_municipality,
-                industry4digit_country, industry4digit_department,
-                industry4digit_msa, industry2digit_department,
-                industry4digit_municipality,
-                trade4digit_rcpy_municipality,
-                industry2digit_msa,
-                trade4digit_rcpy_department, trade4digit_rcpy_msa,
-                trade4digit_rcpy_country, population,
-                gdp_nominal_department, gdp_real_department,
-                occupation2digit, occupation2digit_industry2digit,
-                industry2digit_country, livestock_level1_country,
-                livestock_level1_department,
-                livestock_level1_municipality,
-                agproduct_level3_country, agproduct_level3_department,
-                agproduct_level3_municipality,
-                nonagric_level3_country, nonagric_level3_department,
-                nonagric_level3_municipality,
-                land_use_level2_country, land_use_level2_department,
-                land_use_level2_municipality, farmtype_level2_country,
-                farmtype_level2_department, farmtype_level2_municipality,
-                farmsize_level1_country, farmsize_level1_department,
-                farmsize_level1_municipality,
-            )
+            enable_from_config(c)
 
             from datasets import (
                 product_classification,
@@ -69,7 +449,6 @@ if __name__ == "__main__":
                 farmsize_classification,
             )
 
-
             products = classification_to_models(product_classification,
                                                 models.HSProduct)
             db.session.add_all(products)
@@ -125,374 +504,24 @@ if __name__ == "__main__":
             db.session.add_all(countries)
             db.session.commit()
 
-            # Country product year
-            ret = process_dataset(trade4digit_country)
-
-            df = ret[('location_id', 'product_id', 'year')].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("country_product_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Department product year
-            ret = process_dataset(trade4digit_department)
-
-            df = ret[('product_id', 'year')].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("product_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            df = ret[('location_id', 'product_id', 'year')].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("department_product_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Department-year product
-            dy_p = ret[('location_id', 'year')].reset_index()
-
-            # Department - year industry
-            ret = process_dataset(industry4digit_department)
-            dy_i = ret[('location_id', 'year')].reset_index()
+            # Entity -> ancestor lookups for the hierarchy endpoint, needed by
+            # the rollups
+            build_closure()
 
-            # GDP data
-            ret = process_dataset(gdp_real_department)
-            gdp_real_df = ret[('location_id', 'year')]
+            # Indexes slow down inserts, build them after everything is in
+            drop_indexes(db.engine)
 
-            ret = process_dataset(gdp_nominal_department)
-            gdp_nominal_df = ret[('location_id', 'year')]
-
-            gdp_df = gdp_real_df.join(gdp_nominal_df).reset_index()
+            # Load all datasets, running the independent ones in parallel
+            run_graph(import_tasks(), workers=import_workers(),
+                      initializer=init_worker,
+                      callback=lambda name: print("Loaded {}".format(name)))
 
-            # Pop data
-            ret = process_dataset(population)
-            pop_df = ret[('location_id', 'year')].reset_index()
+            build_indexes(db.engine)
 
-            ret = process_dataset(livestock_level1_department)
-            ls_df = ret[('location_id',)].reset_index()
-            ls_df["average_livestock_load"] = ls_df.num_livestock / ls_df.num_farms
-            ls_df["year"] = c["YEAR_AGRICULTURAL_CENSUS"]
-            ls_df = ls_df[["location_id", "average_livestock_load", "year"]]
-
-            # Yield indexes
-            ret = process_dataset(agproduct_level3_department)
-            agproduct_df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
-            agproduct_df = agproduct_df\
-                .groupby(["location_id", "year"])\
-                .apply(weighted_mean("yield_index", "land_harvested"))
-            agproduct_df.name = "yield_index"
-            agproduct_df = agproduct_df.reset_index()
-
-            # Merge all dept-year variables together
-            def filter_year_range(df, min_year, max_year):
-                return df[(min_year <= df.year) & (df.year <= max_year)]
-
-            df_p = filter_year_range(dy_p, c["YEAR_MIN_TRADE"], c["YEAR_MAX_TRADE"])
-            df_i = filter_year_range(dy_i, c["YEAR_MIN_INDUSTRY"], c["YEAR_MAX_INDUSTRY"])
-            gdp_df = filter_year_range(gdp_df, c["YEAR_MIN_DEMOGRAPHIC"], c["YEAR_MAX_DEMOGRAPHIC"])
-            pop_df = filter_year_range(pop_df, c["YEAR_MIN_DEMOGRAPHIC"], c["YEAR_MAX_DEMOGRAPHIC"])
-            ls_df = filter_year_range(ls_df, c["YEAR_AGRICULTURAL_CENSUS"], c["YEAR_AGRICULTURAL_CENSUS"])
-            agproduct_df = filter_year_range(agproduct_df, c["YEAR_MIN_AGPRODUCT"], c["YEAR_MAX_AGPRODUCT"])
-
-            dy = dy_p.merge(dy_i, on=["location_id", "year"], how="outer")
-            dy = dy.merge(gdp_df, on=["location_id", "year"], how="outer")
-            dy = dy.merge(pop_df, on=["location_id", "year"], how="outer")
-            dy = dy.merge(ls_df, on=["location_id", "year"], how="left")
-            dy = dy.merge(agproduct_df, on=["location_id", "year"], how="left")
-
-            dy["gdp_pc_nominal"] = dy.gdp_nominal / dy.population
-            dy["gdp_pc_real"] = dy.gdp_real / dy.population
-
-            dy.to_sql("department_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Municipality product year
-            ret = process_dataset(trade4digit_municipality)
-
-            df = ret[('location_id', 'product_id', 'year')].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("municipality_product_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # MSA product year
-            ret = process_dataset(trade4digit_msa)
-
-            df = ret[('location_id', 'product_id', 'year')].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("msa_product_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            trade_msa_year = ret[('location_id', 'year')]
-
-            # Country - trade rcpy
-            ret = process_dataset(trade4digit_rcpy_country)
-
-            df = ret[("country_id", "location_id", "year")].reset_index()
-            df.to_sql("country_country_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            df = ret[("product_id", "country_id", "year")].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("partner_product_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            # MSA - trade rcpy
-            ret = process_dataset(trade4digit_rcpy_msa)
-
-            df = ret[("country_id", "location_id", "year")].reset_index()
-            df.to_sql("country_msa_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            # Municipality - trade rcpy
-            ret = process_dataset(trade4digit_rcpy_municipality)
-
-            df = ret[("country_id", "location_id", "year")].reset_index()
-            df.to_sql("country_municipality_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            df = ret[("country_id", "location_id", "product_id", "year")].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("country_municipality_product_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            # Department - trade rcpy
-            ret = process_dataset(trade4digit_rcpy_department)
-
-            df = ret[("country_id", "location_id", "product_id", "year")].reset_index()
-            df["level"] = "4digit"
-            df.to_sql("country_department_product_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            df = ret[("country_id", "location_id", "year")].reset_index()
-            df.to_sql("country_department_year", db.engine,
-                      index=False, chunksize=10000, if_exists="append")
-
-            # Country - industry- y ear
-            ret = process_dataset(industry4digit_country)
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "class"
-            df.to_sql("country_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Department - industry - year
-            ret = process_dataset(industry4digit_department)
-
-            df = ret[('industry_id', 'year')].reset_index()
-            df["level"] = "class"
-            df.to_sql("industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "class"
-            df.to_sql("department_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Country - two digit industry - year
-            ret = process_dataset(industry2digit_country)
-            df = ret[('industry_id', 'year')].reset_index()
-            df["level"] = "division"
-            df.to_sql("industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Department - two digit industry - year
-            ret = process_dataset(industry2digit_department)
-
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "division"
-            df.to_sql("department_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # MSA - two digit industry - year
-            ret = process_dataset(industry2digit_msa)
-
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "division"
-            df.to_sql("msa_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # MSA - industry - year
-            ret = process_dataset(industry4digit_msa)
-
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "class"
-            df.to_sql("msa_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            industry_msa_year = ret[('location_id', 'year')]
-
-            # MSA year
-            msa_year = industry_msa_year.join(trade_msa_year).reset_index()
-            msa_year.to_sql("msa_year", db.engine, index=False,
-                            chunksize=10000, if_exists="append")
-
-
-            # Municipality - industry - year
-            ret = process_dataset(industry4digit_municipality)
-            df = ret[('location_id', 'industry_id', 'year')].reset_index()
-            df["level"] = "class"
-            df.to_sql("municipality_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Livestock - country
-            ret = process_dataset(livestock_level1_country)
-            df = ret[('location_id', 'livestock_id')].reset_index()
-            df["livestock_level"] = "level1"
-            df.to_sql("country_livestock_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Livestock - department
-            ret = process_dataset(livestock_level1_department)
-            df = ret[('location_id', 'livestock_id')].reset_index()
-            df["livestock_level"] = "level1"
-            df.to_sql("department_livestock_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            df = ret[('location_id',)].reset_index()
-            df["average_livestock_load"] = df.num_livestock / df.num_farms
-            df = df.drop(["num_livestock", "num_farms"], axis=1)
-            df["livestock_level"] = "level1"
-            df.to_sql("livestock_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Livestock - municipality
-            ret = process_dataset(livestock_level1_municipality)
-            df = ret[('location_id', 'livestock_id')].reset_index()
-            df["livestock_level"] = "level1"
-            df.to_sql("municipality_livestock_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            ls_df = ret[('location_id',)].reset_index()
-            ls_df["average_livestock_load"] = ls_df.num_livestock / ls_df.num_farms
-            ls_df["year"] = c["YEAR_AGRICULTURAL_CENSUS"]
-            ls_df = ls_df[["location_id", "average_livestock_load", "year"]]
-
-            ret = process_dataset(agproduct_level3_municipality)
-            agproduct_df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
-            agproduct_df = agproduct_df\
-                .groupby(["location_id", "year"])\
-                .apply(weighted_mean("yield_index", "land_harvested"))
-            agproduct_df.name = "yield_index"
-            agproduct_df = agproduct_df.reset_index()
-
-            my = ls_df.merge(agproduct_df, on=["location_id", "year"], how="outer")
-            my.to_sql("municipality_year", db.engine, index=False,
-                         chunksize=10000, if_exists="append")
-
-            # AgriculturalProduct - country
-            ret = process_dataset(agproduct_level3_country)
-            df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
-            df["agproduct_level"] = "level3"
-            df.to_sql("country_agproduct_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # AgriculturalProduct - department
-            ret = process_dataset(agproduct_level3_department)
-            df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
-            df["agproduct_level"] = "level3"
-            df.to_sql("department_agproduct_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # AgriculturalProduct - municipality
-            ret = process_dataset(agproduct_level3_municipality)
-            df = ret[('location_id', 'agproduct_id', 'year')].reset_index()
-            df["agproduct_level"] = "level3"
-            df.to_sql("municipality_agproduct_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Nonagric - country
-            ret = process_dataset(nonagric_level3_country)
-            df = ret[('location_id', 'nonag_id')].reset_index()
-            df["nonag_level"] = "level3"
-            df.to_sql("country_nonag_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Nonagric - department
-            ret = process_dataset(nonagric_level3_department)
-            df = ret[('location_id', 'nonag_id')].reset_index()
-            df["nonag_level"] = "level3"
-            df.to_sql("department_nonag_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Nonagric - municipality
-            ret = process_dataset(nonagric_level3_municipality)
-            df = ret[('location_id', 'nonag_id')].reset_index()
-            df["nonag_level"] = "level3"
-            df.to_sql("municipality_nonag_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-
-            # LandUse - country
-            ret = process_dataset(land_use_level2_country)
-            df = ret[('location_id', 'land_use_id')].reset_index()
-            df["land_use_level"] = "level2"
-            df.to_sql("country_land_use_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # LandUse - department
-            ret = process_dataset(land_use_level2_department)
-            df = ret[('location_id', 'land_use_id')].reset_index()
-            df["land_use_level"] = "level2"
-            df.to_sql("department_land_use_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # LandUse - municipality
-            ret = process_dataset(land_use_level2_municipality)
-            df = ret[('location_id', 'land_use_id')].reset_index()
-            df["land_use_level"] = "level2"
-            df.to_sql("municipality_land_use_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmType - country
-            ret = process_dataset(farmtype_level2_country)
-            df = ret[('location_id', 'farmtype_id')].reset_index()
-            df["farmtype_level"] = "level2"
-            df.to_sql("country_farmtype_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmType - department
-            ret = process_dataset(farmtype_level2_department)
-            df = ret[('location_id', 'farmtype_id')].reset_index()
-            df["farmtype_level"] = "level2"
-            df.to_sql("department_farmtype_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmType - municipality
-            ret = process_dataset(farmtype_level2_municipality)
-            df = ret[('location_id', 'farmtype_id')].reset_index()
-            df["farmtype_level"] = "level2"
-            df.to_sql("municipality_farmtype_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmSize - country
-            ret = process_dataset(farmsize_level1_country)
-            df = ret[('location_id', 'farmsize_id')].reset_index()
-            df["farmsize_level"] = "level1"
-            df.to_sql("country_farmsize_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmSize - department
-            ret = process_dataset(farmsize_level1_department)
-            df = ret[('location_id', 'farmsize_id')].reset_index()
-            df["farmsize_level"] = "level1"
-            df.to_sql("department_farmsize_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # FarmSize - municipality
-            ret = process_dataset(farmsize_level1_municipality)
-            df = ret[('location_id', 'farmsize_id')].reset_index()
-            df["farmsize_level"] = "level1"
-            df.to_sql("municipality_farmsize_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Occupation - year
-            ret = process_dataset(occupation2digit)
-            df = ret[('occupation_id')].reset_index()
-            df["level"] = "minor_group"
-            df.to_sql("occupation_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
-
-            # Occupation - industry - year
-            ret = process_dataset(occupation2digit_industry2digit)
-            df = ret[('occupation_id', 'industry_id')].reset_index()
-            df["level"] = "minor_group"
-            df.to_sql("occupation_industry_year", db.engine, index=False,
-                      chunksize=10000, if_exists="append")
+            # Invalidates cached responses from the previous data
+            version = stamp_dataset_version()
 
+            # Prerender responses so the API can serve them from disk
+            if c.get("SNAPSHOT_ROOT") is not None:
+                render_snapshots(app, SnapshotStore(c["SNAPSHOT_ROOT"]),
+                                 version)
@@ -0,0 +1,208 @@
+"""Tools for managing the composite indexes declared on the fact tables in
+:py:mod:`colombia.data.models`, and for checking that the queries the API runs
+actually use them.
+
+Indexes slow bulk inserts down considerably, so the import drops them before
+loading data and builds them again afterwards."""
+
+from contextlib import contextmanager
+import re
+
+from sqlalchemy import event, inspect
+
+from .data.models import IndexedMixin
+
+
+def indexed_models():
+    """Return all concrete models that declare indexes via
+    :py:class:`~colombia.data.models.IndexedMixin`."""
+    models = []
+    to_visit = list(IndexedMixin.__subclasses__())
+    while to_visit:
+        cls = to_visit.pop()
+        to_visit.extend(cls.__subclasses__())
+        if "__table__" in cls.__dict__:
+            models.append(cls)
+    return sorted(models, key=lambda model: model.__tablename__)
+
+
+def fact_tables():
+    """Names of all tables managed by this module."""
+    return [model.__tablename__ for model in indexed_models()]
+
+
+def declared_indexes(tables=None):
+    """Yield all declared fact table indexes, optionally only those for the
+    given table names."""
+    for model in indexed_models():
+        if tables is None or model.__tablename__ in tables:
+            for index in sorted(model.__table__.indexes, key=lambda i: i.name):
+                yield index
+
+
+def existing_indexes(engine, table_name):
+    """Names of the indexes that currently exist in the database for a table,
+    or None if the table doesn't exist."""
+    inspector = inspect(engine)
+    if table_name not in inspector.get_table_names():
+        return None
+    return set(index["name"] for index in inspector.get_indexes(table_name))
+
+
+def build_indexes(engine, tables=None):
+    """Create any declared indexes that are missing from the database. Returns
+    the names of the indexes created."""
+    created = []
+    for index in declared_indexes(tables):
+        existing = existing_indexes(engine, index.table.name)
+        if existing is not None and index.name not in existing:
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+
+def drop_indexes(engine, tables=None):
+    """Drop all declared indexes that exist in the database. Returns the names
+    of the indexes dropped."""
+    dropped = []
+    for index in declared_indexes(tables):
+        existing = existing_indexes(engine, index.table.name)
+        if existing is not None and index.name in existing:
+            index.drop(bind=engine)
+            dropped.append(index.name)
+    return dropped
+
+
+def rebuild_indexes(engine, tables=None):
+    """Drop and recreate declared indexes, e.g. to defragment them after a
+    load."""
+    drop_indexes(engine, tables)
+    return build_indexes(engine, tables)
+
+
+@contextmanager
+def indexes_dropped(engine, tables=None):
+    """Drop indexes for the duration of a bulk load, and build them again
+    afterwards."""
+    drop_indexes(engine, tables)
+    try:
+        yield
+    finally:
+        build_indexes(engine, tables)
+
+
+@contextmanager
+def capture_queries(engine):
+    """Collect the (statement, parameters) pairs of all queries executed on
+    the engine within the block."""
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        queries.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def explain(engine, statement, parameters=()):
+    """Return the query plan for a statement as a list of strings, one per
+    plan step."""
+    if engine.dialect.name == "sqlite":
+        rows = engine.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [row[-1] for row in rows]
+    elif engine.dialect.name == "postgresql":
+        rows = engine.execute("EXPLAIN " + statement, parameters)
+        return [row[0] for row in rows]
+    else:
+        raise ValueError("Don't know how to EXPLAIN on {}."
+                         .format(engine.dialect.name))
+
+
+def unindexed_scans(plan, tables=None):
+    """Given a query plan from :py:func:`explain`, return the steps that read
+    one of the fact tables without using an index."""
+    if tables is None:
+        tables = fact_tables()
+
+    bad_steps = []
+    for step in plan:
+        mentioned = [table for table in tables
+                     if re.search(r"\b{}\b".format(table), step)]
+        if not mentioned:
+            continue
+
+        # sqlite: "SEARCH [TABLE] foo USING INDEX bar (x=?)"
+        # postgres: "Index Scan using bar on foo", "Seq Scan on foo"
+        if step.startswith("SEARCH") and ("INDEX" in step or
+                                          "PRIMARY KEY" in step):
+            continue
+        if "Index Scan" in step or "Index Only Scan" in step:
+            continue
+        if "Bitmap Heap Scan" in step:
+            # Always preceded by a Bitmap Index Scan
+            continue
+
+        bad_steps.append(step)
+    return bad_steps
+
+
+def subdataset_urls(entity_ids):
+    """Yield one /data/ url per entity_entity_year subdataset and level,
+    for the given {entity_type: [ids]} sample. Used to check query plans."""
+    from .data.views import entity_entity_year
+
+    for entity_type, entity_config in sorted(entity_entity_year.items()):
+        for entity_id in entity_ids.get(entity_type, []):
+            subdatasets = entity_config["subdatasets"]
+            for subdataset, config in sorted(subdatasets.items()):
+                for level in config["levels"]:
+                    yield "/data/{}/{}/{}/?level={}".format(
+                        entity_type, entity_id, subdataset, level)
+
+
+def check_query_plans(app, engine, entity_ids):
+    """Request every subdataset url and EXPLAIN each query it runs. Returns a
+    dict of url -> list of problems: plan steps that scan a fact table without
+    an index, a response other than 200, or no queries at all. Asking for a
+    level a subdataset doesn't have data at is fine. An empty dict means
+    every subdataset query is indexed."""
+
+    # Make sure the responses come from the database
+    config_backup = {key: app.config.get(key)
+                     for key in ["RESPONSE_CACHE", "SNAPSHOT_ROOT"]}
+    app.config["RESPONSE_CACHE"] = False
+    app.config["SNAPSHOT_ROOT"] = None
+
+    problems = {}
+    try:
+        client = app.test_client()
+        for url in subdataset_urls(entity_ids):
+            with capture_queries(engine) as queries:
+                response = client.get(url)
+
+            if response.status_code == 400 and \
+                    b"Data doesn't exist" in response.get_data():
+                continue
+            if response.status_code != 200:
+                problems[url] = ["Responded with {}"
+                                 .format(response.status_code)]
+                continue
+
+            selects = [(statement, parameters)
+                       for statement, parameters in queries
+                       if statement.lstrip().upper().startswith("SELECT")]
+            if not selects:
+                problems[url] = ["Ran no queries"]
+
+            for statement, parameters in selects:
+                bad_steps = unindexed_scans(
+                    explain(engine, statement, parameters))
+                if bad_steps:
+                    problems.setdefault(url, []).extend(bad_steps)
+    finally:
+        app.config.update(config_backup)
+    return problems
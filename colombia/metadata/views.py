@@ -1,13 +1,12 @@
 from flask import request, Blueprint, jsonify
-from .models import HSProduct, Industry
 from ..api_schemas import marshal
 from .. import api_schemas as schemas
-from ..core import db
+from ..caching import cached_response
+from ..hierarchy import ancestors
 
 from ..entities import metadata_apis
 
 from atlas_core.helpers.flask import abort
-from sqlalchemy.orm import aliased
 
 
 def make_metadata_api(metadata_class):
@@ -42,7 +41,8 @@ def register_metadata_apis(metadata_apis):
     for entity_name, settings in metadata_apis.items():
 
         # Generate handler function for entity
-        api_func = make_metadata_api(settings["entity_model"])
+        api_func = cached_response(
+            make_metadata_api(settings["entity_model"]))
 
         # Singular endpoint e.g. /entity/7
         metadata_app.add_url_rule(
@@ -65,28 +65,43 @@ metadata_app = Blueprint("metadata", __name__)
 register_metadata_apis(metadata_apis)
 
 
+#: Level names the hierarchy endpoint used to accept before it was generic
+LEGACY_LEVELS = {
+    "industries": {"4digit": "class"},
+}
+
+
 @metadata_app.route("/<string:entity_name>/hierarchy")
+@cached_response
 def hierarchy(entity_name):
-
+    """Map every entity at ?from_level= to its ancestor at ?to_level=, e.g.
+    /metadata/products/hierarchy?from_level=4digit&to_level=section.
+
+    For industries, ?from_level=4digit is a deprecated alias of class, from
+    when this only answered 4digit to section. That used to map each class to
+    its grandparent, which is a division, and now maps it to its actual
+    section. Clients that relied on the old mapping should ask for
+    ?from_level=class&to_level=division instead.
+
+    :code 400: Unknown entity or level
+    """
+
+    entity_types = {settings["plural"]: entity_type
+                    for entity_type, settings in metadata_apis.items()}
+    if entity_name not in entity_types:
+        raise abort(400, body="Unknown entity {}.".format(entity_name))
+    entity_type = entity_types[entity_name]
+    entity_levels = metadata_apis[entity_type]["entity_model"].LEVELS
+
+    legacy_levels = LEGACY_LEVELS.get(entity_name, {})
     from_level = request.args.get("from_level", None)
+    from_level = legacy_levels.get(from_level, from_level)
     to_level = request.args.get("to_level", None)
+    to_level = legacy_levels.get(to_level, to_level)
+
+    if from_level not in entity_levels or to_level not in entity_levels:
+        raise abort(400, body="""Expected ?from_level= and ?to_level= to be
+                    one of: {}""".format(", ".join(entity_levels)))
 
-    if entity_name == "products":
-        if from_level == "4digit" and to_level == "section":
-            p, p2, p3 = HSProduct, aliased(HSProduct), aliased(HSProduct)
-            q = db.session.query(p.id, p3.id)\
-                .join(p2, p2.id == p.parent_id)\
-                .join(p3, p3.id == p2.parent_id)\
-                .all()
-            return jsonify(data=dict(q))
-    elif entity_name == "industries":
-        if from_level == "4digit" and to_level == "section":
-            i, i2, i3 = Industry, aliased(Industry), aliased(Industry)
-            q = db.session.query(i.id, i3.id)\
-                .join(i2, i2.id == i.parent_id)\
-                .join(i3, i3.id == i2.parent_id)\
-                .all()
-            return jsonify(data=dict(q))
-
-    raise abort(400, body="""This API is still a fixture, try
-                ?from_level=4digit&to_level=section.""")
+    q = ancestors(entity_type, from_level, to_level)
+    return jsonify(data=dict(q.all()))
@@ -26,5 +26,6 @@ from .data.models import (CountryProductYear, DepartmentProductYear,
                           CountryNonagYear,
                           DepartmentNonagYear,
                           MunicipalityNonagYear,
+                          DatasetVersion, HierarchyClosure,
                           )
 
@@ -0,0 +1,215 @@
+"""Memoization of :py:func:`colombia.dataset_tools.process_dataset` results,
+so a dataset that's needed more than once in a run only gets processed once.
+
+Results are keyed by a fingerprint of the dataset dict, including the code of
+the functions in it and the contents of its classifications, and are only
+reused while the source files read for them have the same size and mtime.
+Those files are the ones passed through :py:func:`record_input`, which
+``datasets.prefix_path`` does. Results are kept in memory up to a size limit,
+least recently used first out, and optionally also pickled to a directory so
+that later runs and other processes can reuse them.
+
+The fingerprint doesn't cover functions that the dataset's functions call, or
+globals they read, so pass a salt with anything else that changes results,
+like the year ranges in the config."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import os
+import pickle
+import types
+
+import pandas as pd
+
+_cache = None
+_recording = []
+
+
+def record_input(path):
+    """Note that the datasets being processed right now read path. Returns
+    path, so it can wrap the argument of a read."""
+    for files in _recording:
+        files.add(path)
+    return path
+
+
+@contextmanager
+def recording():
+    """Collect the paths passed to :py:func:`record_input` in the block."""
+    files = set()
+    _recording.append(files)
+    try:
+        yield files
+    finally:
+        _recording.remove(files)
+
+
+def _feed(h, value, seen):
+    if isinstance(value, dict):
+        h.update(b"dict")
+        for key in sorted(value, key=repr):
+            _feed(h, key, seen)
+            _feed(h, value[key], seen)
+    elif isinstance(value, (list, tuple)):
+        h.update(type(value).__name__.encode("utf-8"))
+        for item in value:
+            _feed(h, item, seen)
+    elif isinstance(value, (set, frozenset)):
+        h.update(b"set")
+        for item in sorted(value, key=repr):
+            _feed(h, item, seen)
+    elif isinstance(value, types.FunctionType):
+        h.update("{}.{}".format(value.__module__, value.__qualname__)
+                 .encode("utf-8"))
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        _feed(h, value.__code__, seen)
+        _feed(h, value.__defaults__, seen)
+        for cell in value.__closure__ or ():
+            try:
+                _feed(h, cell.cell_contents, seen)
+            except ValueError:
+                h.update(b"empty")
+    elif isinstance(value, types.CodeType):
+        h.update(value.co_code)
+        _feed(h, value.co_consts, seen)
+        _feed(h, value.co_names, seen)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(repr(getattr(value, "columns", value.name)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(getattr(value, "table", None), pd.DataFrame):
+        # Classifications
+        _feed(h, value.table, seen)
+    elif isinstance(value, bytes):
+        h.update(value)
+    else:
+        h.update(repr(value).encode("utf-8"))
+
+
+def fingerprint(value):
+    """A hash of a dataset dict, or anything in one, that stays the same
+    between runs as long as the dataset does."""
+    h = hashlib.sha1()
+    _feed(h, value, set())
+    return h.hexdigest()
+
+
+def file_stats(paths):
+    """path -> (size, mtime) for each path, or None if it's gone."""
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats[path] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def result_size(ret):
+    """Memory used by the facet DataFrames of a process_dataset result."""
+    return sum(int(df.memory_usage(deep=True).sum()) for df in ret.values())
+
+
+def copy_result(ret):
+    """Copy facets, so callers can't change the cached ones."""
+    return OrderedDict((facet, df.copy()) for facet, df in ret.items())
+
+
+class ProcessCache(object):
+    """Least recently used cache of process_dataset results, up to max_bytes
+    in memory, also pickled to spill_dir if given."""
+
+    def __init__(self, max_bytes, spill_dir=None, salt=""):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.salt = salt
+        self.entries = OrderedDict()
+        self.size = 0
+
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def key(self, dataset):
+        return fingerprint((self.salt, dataset))
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key + ".pickle")
+
+    def get(self, key):
+        """The cached result for key, or None if there isn't a fresh one."""
+        if key in self.entries:
+            files, ret, size = self.entries[key]
+            if file_stats(files) == files:
+                self.entries.move_to_end(key)
+                return copy_result(ret)
+            self.remove(key)
+
+        if self.spill_dir is None:
+            return None
+
+        try:
+            with open(self.spill_path(key), "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if file_stats(entry["files"]) != entry["files"]:
+            return None
+        self.remember(key, entry["files"], entry["result"])
+        return copy_result(entry["result"])
+
+    def put(self, key, paths, ret):
+        """Cache a result that was computed from the files in paths."""
+        files = file_stats(paths)
+        self.remember(key, files, copy_result(ret))
+
+        if self.spill_dir is not None:
+            path = self.spill_path(key)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump({"files": files, "result": ret}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+
+    def remember(self, key, files, ret):
+        size = result_size(ret)
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (files, ret, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+
+
+def enable_process_cache(max_bytes, spill_dir=None, salt=""):
+    """Start memoizing process_dataset in this process."""
+    global _cache
+    _cache = ProcessCache(max_bytes, spill_dir, salt)
+    return _cache
+
+
+def disable_process_cache():
+    global _cache
+    _cache = None
+
+
+def current_cache():
+    return _cache
+
+
+def enable_from_config(config):
+    """Memoize with the PROCESS_CACHE_* settings, salted with the settings
+    datasets.py reads."""
+    salt = repr(sorted((key, value) for key, value in config.items()
+                       if key == "DATASET_ROOT" or key.startswith("YEAR_")))
+    return enable_process_cache(
+        config.get("PROCESS_CACHE_MAX_BYTES", 2 * 1024 ** 3),
+        config.get("PROCESS_CACHE_DIR", None),
+        salt)
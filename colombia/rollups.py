@@ -0,0 +1,98 @@
+"""Rollups of fact tables to the higher levels of their classification, e.g.
+department_product_year from 4digit products up to 2digit and section, so that
+?level=section works without the client summing thousands of rows.
+
+Only additive metrics are summed. Everything else, like RCA, density or
+averages, doesn't add up across children and is left null on rolled up rows.
+Plant and farm counts are left null too wherever one plant or farm can be in
+several children, e.g. a farm with both cattle and pigs would be counted once
+for each. Non-agricultural activities have nothing else to sum, so they aren't
+rolled up at all.
+
+Parents come from the hierarchy closure table, so
+:py:func:`colombia.hierarchy.build_closure` needs to have run first."""
+
+import pandas as pd
+
+from .bulkload import bulk_load
+from .core import db
+from .data.models import HierarchyClosure
+
+#: entity type -> level column and additive metrics in its fact tables
+ROLLUPS = {
+    "product": {
+        "level_field": "level",
+        "additive": ["export_value", "import_value"],
+    },
+    "industry": {
+        "level_field": "level",
+        "additive": ["employment", "wages", "num_establishments"],
+    },
+    "livestock": {
+        "level_field": "livestock_level",
+        "additive": ["num_livestock"],
+    },
+    "agproduct": {
+        "level_field": "agproduct_level",
+        "additive": ["land_sown", "land_harvested", "production_tons"],
+    },
+    "land_use": {
+        "level_field": "land_use_level",
+        "additive": ["area"],
+    },
+    "farmtype": {
+        "level_field": "farmtype_level",
+        "additive": ["num_farms"],
+    },
+}
+
+
+def ancestor_table(entity_type, from_level, to_levels=None):
+    """DataFrame of descendant_id, ancestor_id, ancestor_level for every
+    entity at from_level and each of its ancestors, optionally only the ones
+    at to_levels."""
+    q = db.session\
+        .query(HierarchyClosure.descendant_id, HierarchyClosure.ancestor_id,
+               HierarchyClosure.ancestor_level)\
+        .filter_by(entity_type=entity_type, descendant_level=from_level)\
+        .filter(HierarchyClosure.depth > 0)
+    if to_levels is not None:
+        q = q.filter(HierarchyClosure.ancestor_level.in_(to_levels))
+    return pd.DataFrame(q.all(), columns=["descendant_id", "ancestor_id",
+                                          "ancestor_level"])
+
+
+def rollup(df, entity_type, to_levels=None):
+    """Sum the additive metrics of a fact table DataFrame, with all rows at
+    one level of entity_type, up to every higher level or only to_levels.
+    Rows are grouped by the other id columns and the year."""
+
+    settings = ROLLUPS[entity_type]
+    id_field = entity_type + "_id"
+    level_field = settings["level_field"]
+
+    from_levels = df[level_field].unique()
+    assert len(from_levels) == 1, "Can only roll up one level at a time."
+
+    keys = [column for column in df.columns
+            if column != id_field and
+            (column.endswith("_id") or column == "year")]
+    additive = [column for column in settings["additive"]
+                if column in df.columns]
+
+    ancestors = ancestor_table(entity_type, from_levels[0], to_levels)
+    df = df[keys + [id_field] + additive]\
+        .merge(ancestors, left_on=id_field, right_on="descendant_id")
+
+    # Groups with only nulls stay null rather than adding up to 0
+    df = df.groupby(keys + ["ancestor_id", "ancestor_level"])[additive]\
+        .sum(min_count=1)\
+        .reset_index()
+    return df.rename(columns={"ancestor_id": id_field,
+                              "ancestor_level": level_field})
+
+
+def write_rollups(df, table_name, entity_type, to_levels=None):
+    """Roll df up and append the result to the table it came from. Returns
+    the :py:class:`~colombia.bulkload.LoadStats` of that."""
+    return bulk_load(rollup(df, entity_type, to_levels), table_name)
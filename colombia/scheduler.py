@@ -0,0 +1,104 @@
+"""A small scheduler for running a graph of tasks with dependencies on a
+process pool, used by :py:mod:`colombia.import` so that independent datasets
+load in parallel.
+
+Each task is a function plus the names of the tasks it depends on. It gets
+called with its arguments and a dict of the return values of its
+dependencies, so those need to be picklable."""
+
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait)
+
+#: func is called as func(*args, inputs) where inputs maps the names in deps
+#: to what those tasks returned
+Task = namedtuple("Task", ["func", "args", "deps"])
+
+# Whether this worker process has run the initializer yet
+_initialized = False
+
+
+def check_graph(tasks):
+    """Make sure every dependency exists and there are no cycles. Returns the
+    task names in an order where each comes after its dependencies."""
+
+    for name, task in tasks.items():
+        missing = [dep for dep in task.deps if dep not in tasks]
+        if missing:
+            raise ValueError("Task {} depends on unknown tasks {}"
+                             .format(name, missing))
+
+    order, done = [], set()
+    remaining = sorted(tasks)
+    while remaining:
+        ready = [name for name in remaining
+                 if all(dep in done for dep in tasks[name].deps)]
+        if not ready:
+            raise ValueError("Tasks {} depend on each other"
+                             .format(remaining))
+        order.extend(ready)
+        done.update(ready)
+        remaining = [name for name in remaining if name not in done]
+    return order
+
+
+def run_task(task, results, initializer=None):
+    """Run a task with the results of its dependencies. The initializer, if
+    any, runs before the first task in each process. ProcessPoolExecutor
+    only takes an initializer itself from python 3.7 on."""
+    global _initialized
+    if initializer is not None and not _initialized:
+        initializer()
+        _initialized = True
+
+    inputs = {dep: results[dep] for dep in task.deps}
+    return task.func(*(tuple(task.args) + (inputs,)))
+
+
+def run_graph(tasks, workers=None, initializer=None, callback=None):
+    """Run a dict of name -> :py:class:`Task`, each as soon as its
+    dependencies are done, on a pool of worker processes (by default one
+    per core). With workers=1 everything runs in this process instead, in
+    dependency order. The initializer runs once in each worker process, and
+    callback(name) after each task finishes.
+
+    Returns a dict of name -> return value. If any task fails, no new tasks
+    are started and the exception is raised once the running ones are
+    done."""
+
+    order = check_graph(tasks)
+    results = {}
+
+    if workers == 1:
+        for name in order:
+            results[name] = run_task(tasks[name], results)
+            if callback is not None:
+                callback(name)
+        return results
+
+    pending = list(order)
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            ready = [name for name in pending
+                     if all(dep in results for dep in tasks[name].deps)]
+            for name in ready:
+                pending.remove(name)
+                future = pool.submit(run_task, tasks[name],
+                                     {dep: results[dep]
+                                      for dep in tasks[name].deps},
+                                     initializer)
+                running[future] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                exception = future.exception()
+                if exception is not None:
+                    wait(running)
+                    raise exception
+                results[name] = future.result()
+                if callback is not None:
+                    callback(name)
+
+    return results
@@ -0,0 +1,182 @@
+"""Precomputed response snapshots. Since the data is static between imports,
+the import renders every addressable subdataset response once and stores it
+gzipped on disk. The API then serves those bytes directly, and only falls back
+to querying the database for requests that weren't rendered.
+
+The store is content addressed, so identical responses (e.g. all the empty
+ones) are only stored once::
+
+    SNAPSHOT_ROOT/
+        blobs/ab/ab12...ef           gzipped body, named by its sha1
+        manifests/<version>.json     normalized request -> blob
+"""
+
+from flask import current_app
+from werkzeug.datastructures import Headers
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from .compression import negotiate_encoding
+from .versioning import dataset_version
+
+
+class SnapshotStore(object):
+    """Gzipped response bodies on disk, addressed by content hash, plus one
+    manifest per dataset version that maps requests to bodies."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def manifest_path(self, version):
+        return os.path.join(self.root, "manifests", version + ".json")
+
+    def _write_atomic(self, path, data):
+        """Write to a temp file and rename, so readers never see a partially
+        written file."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def put(self, body):
+        """Store a response body, returning its digest."""
+        digest = hashlib.sha1(body).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            self._write_atomic(path, gzip.compress(body))
+        return digest
+
+    def get(self, digest):
+        """Get the gzipped bytes for a digest."""
+        with open(self.blob_path(digest), "rb") as f:
+            return f.read()
+
+    def write_manifest(self, version, manifest):
+        data = json.dumps(manifest, sort_keys=True).encode("utf-8")
+        self._write_atomic(self.manifest_path(version), data)
+
+    def load_manifest(self, version):
+        """Load the manifest for a version, or None if there isn't one."""
+        try:
+            with open(self.manifest_path(version), "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except FileNotFoundError:
+            return None
+
+
+def snapshot_store():
+    """The SnapshotStore configured by SNAPSHOT_ROOT, or None if snapshots are
+    disabled."""
+    root = current_app.config.get("SNAPSHOT_ROOT", None)
+    if root is None:
+        return None
+    return SnapshotStore(root)
+
+
+def current_manifest():
+    """The manifest for the current dataset version, loaded once per worker
+    per version. Empty if nothing was rendered for this version."""
+    version = dataset_version()
+    state = current_app.extensions.get("snapshots", None)
+    if state is None or state["version"] != version:
+        manifest = snapshot_store().load_manifest(version)
+        state = {"version": version, "manifest": manifest or {}}
+        current_app.extensions["snapshots"] = state
+    return state["manifest"]
+
+
+def snapshot_entry(key):
+    """The manifest entry of the snapshot for the normalized request key, or
+    None if there is no snapshot for it."""
+    if snapshot_store() is None:
+        return None
+    return current_manifest().get(key, None)
+
+
+def snapshot_encoding():
+    """The encoding snapshots are served with for the current request. They
+    are stored gzipped, so that's either gzip or, if the client doesn't take
+    gzip or COMPRESS is off, None for decompressed."""
+    return negotiate_encoding(["gzip"])
+
+
+def snapshot_response(entry):
+    """Build a response for a :py:func:`snapshot_entry` from the snapshot
+    store."""
+    body = snapshot_store().get(entry["digest"])
+    headers = Headers()
+    headers.add("Vary", "Accept-Encoding")
+    if snapshot_encoding() == "gzip":
+        headers.add("Content-Encoding", "gzip")
+    else:
+        body = gzip.decompress(body)
+
+    return current_app.response_class(body, mimetype=entry["mimetype"],
+                                      headers=headers)
+
+
+def snapshot_urls():
+    """Yield the url of every response that gets precomputed: each location's
+    subdatasets at each level, and each product's exporters and partners."""
+    from .data.routing import classification_index
+    from .data.views import entity_entity_year
+
+    to_render = {
+        "location": ["products", "industries", "partners", "livestock",
+                     "agproducts", "land_uses", "farmtypes", "farmsizes",
+                     "nonags"],
+        "product": ["exporters", "partners"],
+    }
+
+    for entity_type, subdatasets in sorted(to_render.items()):
+        entity_ids = sorted(classification_index(entity_type).levels)
+        config = entity_entity_year[entity_type]["subdatasets"]
+        for entity_id in entity_ids:
+            for subdataset in subdatasets:
+                for level in config[subdataset]["levels"]:
+                    yield "/data/{}/{}/{}/?level={}".format(
+                        entity_type, entity_id, subdataset, level)
+
+
+def render_snapshots(app, store, version):
+    """Render every url from :py:func:`snapshot_urls` through the live API
+    and write them to the store under the given dataset version. Requests
+    that don't succeed (e.g. no data at that level) are skipped and will
+    fall through to the database. Returns the number of snapshots."""
+    from .caching import normalized_request
+
+    # Make sure we're rendering from the database
+    config_backup = {key: app.config.get(key)
+                     for key in ["RESPONSE_CACHE", "SNAPSHOT_ROOT"]}
+    app.config["RESPONSE_CACHE"] = False
+    app.config["SNAPSHOT_ROOT"] = None
+
+    manifest = {}
+    try:
+        client = app.test_client()
+        for url in snapshot_urls():
+            response = client.get(url)
+            if response.status_code != 200:
+                continue
+
+            with app.test_request_context(url):
+                key = normalized_request()
+
+            manifest[key] = {
+                "digest": store.put(response.get_data()),
+                "mimetype": response.mimetype,
+            }
+    finally:
+        app.config.update(config_backup)
+
+    store.write_manifest(version, manifest)
+    return len(manifest)
@@ -0,0 +1,180 @@
+"""Read-through cache of the ingestion source files. Parsing the big Stata and
+HDF files over NFS is a large part of an import, and many are read by more
+than one dataset, so the first read of each converts it to an uncompressed
+Feather file on local disk. Later reads memory map that instead.
+
+A cached copy is used while the source has the same size and mtime. If only
+the mtime changed, e.g. because the file was copied again, the source gets
+hashed and the copy is still used if the contents are the same. The hash to
+compare with is taken while the source is first read, for readers that can
+parse from memory, so a cold read still reads the file once. Copies from
+other readers go stale whenever the mtime changes.
+
+Needs pyarrow, see requirements-optimizations.txt. Without it, or without a
+cache directory, files are read directly."""
+
+from functools import lru_cache
+import hashlib
+from io import BytesIO
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+
+@lru_cache(maxsize=None)
+def _installed(module_name):
+    try:
+        __import__(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def file_hash(path, block_size=2 ** 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hashing_read(reader, path, *args, block_size=2 ** 20, **kwargs):
+    """Read path into memory a block at a time, hashing the blocks on the way,
+    and parse it from there. Returns the frame and the sha1 of the file."""
+    h = hashlib.sha1()
+    buffer = BytesIO()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+            buffer.write(block)
+    buffer.seek(0)
+    return reader(buffer, *args, **kwargs), h.hexdigest()
+
+
+def cache_key(reader, path, args, kwargs):
+    """Name of the cached copy of path read with these reader arguments."""
+    description = json.dumps([reader.__name__, os.path.abspath(path),
+                              repr(args), repr(sorted(kwargs.items()))])
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def is_fresh(manifest, path):
+    """Whether a cached copy described by manifest still matches path. Updates
+    the manifest's mtime when only that changed."""
+    stat = os.stat(path)
+    if stat.st_size != manifest["size"]:
+        return False
+    if stat.st_mtime == manifest["mtime"]:
+        return True
+    if manifest["sha1"] is None or file_hash(path) != manifest["sha1"]:
+        return False
+    manifest["mtime"] = stat.st_mtime
+    return True
+
+
+def to_columnar(df):
+    """Move the index into columns, since Feather only stores the data.
+    Returns the frame and what's needed to put the index back."""
+    if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and \
+            df.index.step == 1 and df.index.name is None:
+        return df, None
+    names = list(df.index.names)
+    df = df.reset_index()
+    return df, {"columns": list(df.columns[:len(names)]), "names": names}
+
+
+def from_columnar(df, index):
+    if index is None:
+        return df
+    df = df.set_index(index["columns"])
+    df.index.names = index["names"]
+    return df
+
+
+def temp_path(path):
+    """A new temp file next to path, unique so that processes caching the same
+    source at the same time don't write over each other's copies."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    return tmp_path
+
+
+def move_into_place(tmp_path, path):
+    """Rename tmp_path to path. Returns False if that failed, e.g. because
+    another process holds path open, in which case its copy is kept."""
+    try:
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        os.remove(tmp_path)
+        return False
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = temp_path(manifest_path)
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    move_into_place(tmp_path, manifest_path)
+
+
+def write_copy(df, cache_path, manifest_path, manifest):
+    """Write the cached copy, or nothing if the frame can't be stored as
+    Feather, e.g. because of columns of mixed types. If another process
+    writes the same copy at the same time, whichever rename comes last wins,
+    both copies are of the same source."""
+    import pyarrow
+    from pyarrow import feather
+
+    df, manifest["index"] = to_columnar(df)
+    tmp_path = temp_path(cache_path)
+    try:
+        feather.write_feather(df, tmp_path, compression="uncompressed")
+    except (pyarrow.ArrowException, TypeError, ValueError):
+        os.remove(tmp_path)
+        return
+    if move_into_place(tmp_path, cache_path):
+        write_manifest(manifest_path, manifest)
+
+
+def cached_read(cache_dir, reader, path, *args, buffered=False, **kwargs):
+    """reader(path, *args, **kwargs), through a cached copy in cache_dir if
+    it's not None. Pass buffered=True if reader can also parse a file object,
+    like pd.read_stata can, to hash the source while reading it."""
+    if cache_dir is None or not _installed("pyarrow"):
+        return reader(path, *args, **kwargs)
+
+    from pyarrow import feather
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(reader, path, args, kwargs)
+    cache_path = os.path.join(cache_dir, key + ".feather")
+    manifest_path = os.path.join(cache_dir, key + ".json")
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if manifest is not None and os.path.exists(cache_path):
+        mtime = manifest["mtime"]
+        if is_fresh(manifest, path):
+            if manifest["mtime"] != mtime:
+                write_manifest(manifest_path, manifest)
+            df = feather.read_table(cache_path, memory_map=True).to_pandas()
+            return from_columnar(df, manifest["index"])
+
+    stat = os.stat(path)
+    if buffered:
+        df, sha1 = hashing_read(reader, path, *args, **kwargs)
+    else:
+        df, sha1 = reader(path, *args, **kwargs), None
+    write_copy(df, cache_path, manifest_path, {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha1": sha1,
+    })
+    return df
@@ -0,0 +1,58 @@
+"""The dataset version is a stamp that :py:mod:`colombia.import` writes after
+loading data. Since the data never changes between imports, anything derived
+from it (cached responses, in-memory indexes) stays valid for as long as the
+version does."""
+
+from datetime import datetime
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from .core import db
+from .data.models import DatasetVersion
+
+#: Version reported when no import has stamped the database yet
+UNVERSIONED = "unversioned"
+
+
+def stamp_dataset_version(version=None):
+    """Record a new dataset version, to be called at the end of an import.
+    Returns the new version string."""
+    if version is None:
+        version = uuid.uuid4().hex
+    db.session.add(DatasetVersion(version=version,
+                                  created_at=datetime.utcnow()))
+    db.session.commit()
+    return version
+
+
+def latest_dataset_version():
+    """Look up the most recently stamped dataset version in the database."""
+    try:
+        stamp = DatasetVersion.query\
+            .order_by(DatasetVersion.id.desc())\
+            .first()
+    except SQLAlchemyError:
+        # e.g. a database from before versioning existed
+        db.session.rollback()
+        return UNVERSIONED
+
+    if stamp is None:
+        return UNVERSIONED
+    return stamp.version
+
+
+def dataset_version():
+    """The current dataset version. To avoid a query per request, it is only
+    looked up again every DATASET_VERSION_TTL seconds per worker."""
+    ttl = current_app.config.get("DATASET_VERSION_TTL", 60)
+    state = current_app.extensions.setdefault("dataset_version", {})
+
+    now = time.time()
+    if "version" not in state or now - state["checked_at"] >= ttl:
+        state["version"] = latest_dataset_version()
+        state["checked_at"] = now
+
+    return state["version"]
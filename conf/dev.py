@@ -7,14 +7,65 @@ SQLALCHEMY_ECHO = False
 SQLALCHEMY_DATABASE_URI = "sqlite:///database.db"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Response cache backend: "simple" (in-process), "filesystem" (also set
+# CACHE_DIR), "redis" (also set CACHE_REDIS_URL) or "null" to disable.
 CACHE_TYPE = "simple"
 CACHE_KEY_PREFIX = "colombia::"
 
+# Cache keys include the dataset version, so entries never need to expire.
+RESPONSE_CACHE = True
+RESPONSE_CACHE_TIMEOUT = 0
+
+# Cache-Control max-age (seconds) to send per blueprint, e.g. for a CDN.
+# Responses also carry an ETag that only changes with the dataset version.
+CACHE_CONTROL_MAX_AGE = {"data": 300, "metadata": 300}
+
+# Compress responses of at least COMPRESS_MIN_SIZE bytes with gzip, or
+# brotli if it's installed and the client accepts it
+COMPRESS = True
+COMPRESS_MIN_SIZE = 500
+
+# Directory of gzipped responses prerendered by the import, None to disable
+SNAPSHOT_ROOT = None
+
+# "sql" queries the database for every request, "columnar" serves the
+# product / industry fact tables from numpy arrays loaded at startup
+DATA_ENGINE = "sql"
+
+# Stream query results out in chunks of STREAM_CHUNK_SIZE rows rather than
+# building whole responses in memory. Streamed responses skip the response
+# cache, so this is best combined with SNAPSHOT_ROOT.
+STREAM_RESPONSES = False
+STREAM_CHUNK_SIZE = 1000
+
+# Most ids a batch request like /data/location/products/?ids=1,2,3 can ask for
+BATCH_MAX_IDS = 50
+
+# Threads (and so pooled database connections) each worker process keeps to
+# fetch the parts of /data/location/<id>/profile/ responses concurrently. 1
+# fetches them one after the other on the request's own thread.
+PROFILE_WORKERS = 4
+
+# How often (seconds) each worker checks for a newly imported dataset version
+DATASET_VERSION_TTL = 60
+
 DEBUG_TB_ENABLED = DEBUG
 PROFILE = False
 PORT = 8001
 
 # Ingestion settings
+# Processes to run the import's independent datasets in, None for one per
+# core. Imports into sqlite always use one.
+IMPORT_WORKERS = None
+# Processed datasets are kept in memory up to this many bytes, so ones used
+# more than once in a run aren't processed again. If PROCESS_CACHE_DIR is set
+# they're also saved there and reused by later runs until the source files
+# change.
+PROCESS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+PROCESS_CACHE_DIR = None
+# Local directory to keep Feather copies of the Stata and HDF source files in,
+# so they're only parsed again when they change. None reads them directly.
+SOURCE_CACHE_DIR = None
 DATASET_ROOT = "/nfs/home/M/makmanalp/shared_space/cid_colombia/Mali/2016Output"
 YEAR_MIN_TRADE = 2007
 YEAR_MAX_TRADE = 2016
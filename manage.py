@@ -1,4 +1,5 @@
-from colombia import create_app, models, core, factories
+from colombia import create_app, models, core, factories, indexes
+from colombia.entities import metadata_apis
 from flask.ext.script import Manager, Shell
 
 import random
@@ -13,6 +14,80 @@ def _make_context():
 
 manager.add_command("shell", Shell(make_context=_make_context))
 
+index_manager = Manager(usage="Build, drop, rebuild or check the indexes on "
+                        "fact tables.")
+manager.add_command("indexes", index_manager)
+
+
+@index_manager.option("-t", "--table", dest="tables", action="append",
+                      help="Only this table (can be repeated)")
+def build(tables=None):
+    """Create missing fact table indexes."""
+    for name in indexes.build_indexes(core.db.engine, tables):
+        print("Created {}".format(name))
+
+
+@index_manager.option("-t", "--table", dest="tables", action="append",
+                      help="Only this table (can be repeated)")
+def drop(tables=None):
+    """Drop fact table indexes, e.g. before a bulk load."""
+    for name in indexes.drop_indexes(core.db.engine, tables):
+        print("Dropped {}".format(name))
+
+
+@index_manager.option("-t", "--table", dest="tables", action="append",
+                      help="Only this table (can be repeated)")
+def rebuild(tables=None):
+    """Drop and recreate fact table indexes."""
+    for name in indexes.rebuild_indexes(core.db.engine, tables):
+        print("Rebuilt {}".format(name))
+
+
+@index_manager.command
+def check():
+    """EXPLAIN the queries of every /data/ subdataset and report the ones
+    that scan a fact table without an index, and subdatasets that fail or
+    don't run any queries."""
+
+    # Pick one entity at each classification level to query with
+    entity_ids = {}
+    for entity_type, settings in metadata_apis.items():
+        model = settings["entity_model"]
+        entity_ids[entity_type] = []
+        for level in model.LEVELS:
+            entity = model.query.filter_by(level=level).first()
+            if entity is not None:
+                entity_ids[entity_type].append(entity.id)
+
+    problems = indexes.check_query_plans(app, core.db.engine, entity_ids)
+    for url, steps in sorted(problems.items()):
+        print(url)
+        for step in steps:
+            print("    " + step)
+
+    if problems:
+        raise SystemExit(1)
+    print("All subdataset queries use an index.")
+
+
+@manager.option("-s", "--suite", dest="suite", default="row_tuples",
+                choices=["row_tuples", "rectangularize", "facets"],
+                help="Which benchmark to run")
+@manager.option("-r", "--repeat", dest="repeat", type=int, default=5,
+                help="Number of timed runs, the best is reported")
+def benchmark(suite="row_tuples", repeat=5):
+    """Run a benchmark: row_tuples compares ORM instances against column
+    tuples on the municipality level tables, rectangularize and facets
+    compare rectangularize() and the dataset facet aggregation against the
+    original implementations."""
+    from colombia import benchmarks
+    suites = {
+        "row_tuples": benchmarks.benchmark_row_tuples,
+        "rectangularize": benchmarks.benchmark_rectangularize,
+        "facets": benchmarks.benchmark_facets,
+    }
+    benchmarks.print_results(suites[suite](repeat))
+
 
 @manager.option("-n", help="Number of dummy things")
 def dummy(n=10):
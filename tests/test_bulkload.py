@@ -0,0 +1,46 @@
+import pytest
+
+# The bulk loader is part of the ingestion, which needs pandas
+pd = pytest.importorskip("pandas")
+
+from colombia import models  # noqa
+from colombia.bulkload import bulk_load, integer_values  # noqa
+from colombia.core import db  # noqa
+
+from . import BaseTestCase
+
+
+class TestBulkLoad(BaseTestCase):
+
+    def test_bulk_load(self):
+        df = pd.DataFrame({
+            "location_id": [1, 1, 2],
+            "product_id": [3, 4, 3],
+            "year": [2012, 2012, 2013],
+            "level": ["4digit", "4digit", "4digit"],
+            "export_value": [10, None, 30],
+            "density": [0.5, 0.25, None],
+        })
+
+        stats = bulk_load(df, "department_product_year", chunk_size=2)
+        assert stats.table == "department_product_year"
+        assert stats.rows == 3
+
+        rows = db.session\
+            .query(models.DepartmentProductYear.location_id,
+                   models.DepartmentProductYear.product_id,
+                   models.DepartmentProductYear.year,
+                   models.DepartmentProductYear.export_value,
+                   models.DepartmentProductYear.density)\
+            .order_by(models.DepartmentProductYear.year,
+                      models.DepartmentProductYear.product_id)\
+            .all()
+        assert rows == [(1, 3, 2012, 10, 0.5),
+                        (1, 4, 2012, None, 0.25),
+                        (2, 3, 2013, 30, None)]
+
+        assert bulk_load(df.iloc[:0], "department_product_year").rows == 0
+
+    def test_integer_values(self):
+        values = integer_values(pd.Series([1.0, None, 30.0]))
+        assert values.tolist() == [1, None, 30]
@@ -1,14 +1,45 @@
 from flask import Flask, url_for, request
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import pytest
 
-from colombia import factories
+import marshmallow as ma
+
+import gzip
+import random
+import json
+import sys
+import tempfile
+
+from colombia import api_schemas as schemas
+from colombia import factories, indexes, models, snapshots
+from colombia.versioning import stamp_dataset_version
 from colombia.core import db
-from colombia.data import routing
+from colombia.data import routing, views
 
 from . import BaseTestCase
 
 
+def add_department_products(num_products=1):
+    """A department and some 4digit products, committed so that rows between
+    them can use their ids."""
+    department = factories.Location(level="department")
+    products = [factories.HSProduct(level="4digit")
+                for i in range(num_products)]
+    db.session.commit()
+    return department, products
+
+
+def add_department_product_year(department, product, **values):
+    """A 4digit DepartmentProductYear row, for 2012 unless values says
+    otherwise."""
+    values.setdefault("year", 2012)
+    row = models.DepartmentProductYear(
+        location_id=department.id, product_id=product.id, level="4digit",
+        **values)
+    db.session.add(row)
+    return row
+
+
 class TestDataAPIs(BaseTestCase):
 
     SQLALCHEMY_DATABASE_URI = "sqlite://"
@@ -153,6 +184,31 @@ class TestDataRouting(BaseTestCase):
         assert p1_level == "2digit"
         assert p2_level == "section"
 
+    def test_classification_index(self):
+        d = factories.Location(level="department")
+        db.session.commit()
+        m1 = factories.Location(level="municipality", parent_id=d.id)
+        m2 = factories.Location(level="municipality", parent_id=d.id)
+        db.session.commit()
+
+        routing.load_classification_indexes()
+
+        with indexes.capture_queries(db.engine) as queries:
+            assert routing.lookup_classification_level("location", d.id) == "department"
+            assert routing.lookup_classification_level("location", m1.id) == "municipality"
+            assert routing.lookup_parent_id("location", m2.id) == d.id
+            assert sorted(routing.lookup_children("location", d.id)) == sorted([m1.id, m2.id])
+            assert routing.lookup_children("location", m1.id) == ()
+
+        # Served from memory, apart from checking the dataset version
+        assert all("dataset_version" in statement
+                   for statement, parameters in queries)
+
+        # Ids that are not in the index still work
+        d2 = factories.Location(level="department")
+        db.session.commit()
+        assert routing.lookup_classification_level("location", d2.id) == "department"
+
     def test_data_route_add(self):
         b = Flask("test_flask")
         routing.add_routes(b, {})
@@ -187,3 +243,687 @@ class TestDataRouting(BaseTestCase):
             assert response.status_code == 200
             assert response.data == b"cats"
             endpoint.assert_called_with(location=2, year=2007)
+
+
+class TestQueryPlans(BaseTestCase):
+
+    def test_indexes_declared(self):
+        for model in indexes.indexed_models():
+            assert len(model.__table__.indexes) > 0
+            for index in model.__table__.indexes:
+                assert len(index.name) <= 63
+
+    def test_drop_and_build_indexes(self):
+        table = "department_product_year"
+
+        dropped = indexes.drop_indexes(db.engine, [table])
+        assert len(dropped) == 2
+        assert indexes.existing_indexes(db.engine, table) == set()
+
+        built = indexes.build_indexes(db.engine, [table])
+        assert sorted(built) == sorted(dropped)
+        assert indexes.build_indexes(db.engine, [table]) == []
+
+    def test_subdataset_queries_use_indexes(self):
+        locations = [factories.Location(level=level)
+                     for level in ["country", "department", "msa",
+                                   "municipality"]]
+        product = factories.HSProduct(level="4digit")
+        db.session.commit()
+
+        entity_ids = {
+            "location": [l.id for l in locations],
+            "product": [product.id],
+            "industry": [1],
+            "livestock": [1],
+            "agproduct": [1],
+            "nonag": [1],
+            "land_use": [1],
+            "farmtype": [1],
+            "farmsize": [1],
+        }
+
+        problems = indexes.check_query_plans(self.app, db.engine, entity_ids)
+        assert problems == {}
+
+        # Cached responses run no queries, so the check goes around the cache
+        self.app.config["RESPONSE_CACHE"] = True
+        self.client.get("/data/location/{}/products/?level=4digit"
+                        .format(locations[1].id))
+        problems = indexes.check_query_plans(self.app, db.engine, entity_ids)
+        assert problems == {}
+        assert self.app.config["RESPONSE_CACHE"] is True
+
+        problems = indexes.check_query_plans(
+            self.app, db.engine, {"location": [12345]})
+        assert problems["/data/location/12345/products/?level=4digit"] == \
+            ["Responded with 404"]
+
+
+class TestSnapshots(BaseTestCase):
+
+    def test_render_and_serve_snapshots(self):
+        self.app.config["DATASET_VERSION_TTL"] = 0
+        self.app.config["RESPONSE_CACHE"] = False
+
+        location, (product,) = add_department_products()
+        add_department_product_year(location, product, export_value=1000,
+                                    import_value=2000)
+        db.session.commit()
+
+        url = "/data/location/{}/products/?level=4digit".format(location.id)
+        live = self.client.get(url).json
+
+        root = tempfile.mkdtemp()
+        version = stamp_dataset_version()
+        store = snapshots.SnapshotStore(root)
+        count = snapshots.render_snapshots(self.app, store, version)
+        assert count > 0
+
+        # Change the data, snapshots should still be served
+        add_department_product_year(location, product, year=2013,
+                                    export_value=1000, import_value=2000)
+        db.session.commit()
+        self.app.config["SNAPSHOT_ROOT"] = root
+
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assert_200(response)
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = json.loads(gzip.decompress(response.data).decode("utf-8"))
+        assert body == live
+
+        response = self.client.get(url)
+        assert "Content-Encoding" not in response.headers
+        assert response.json == live
+
+        # The ETag names the encoding that was actually served
+        self.app.config["COMPRESS"] = False
+        uncompressed = self.client.get(url,
+                                       headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in uncompressed.headers
+        assert uncompressed.json == live
+        assert uncompressed.headers["ETag"] == response.headers["ETag"]
+        self.app.config["COMPRESS"] = True
+        gzipped = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert gzipped.headers["ETag"] != response.headers["ETag"]
+
+        # No snapshots for a new version, so we're back to live queries
+        stamp_dataset_version()
+        response = self.client.get(url)
+        assert len(response.json["data"]) == 2
+
+
+class TestColumnarEngine(BaseTestCase):
+
+    def test_columnar_matches_sql(self):
+        pytest.importorskip("numpy")
+
+        self.app.config["RESPONSE_CACHE"] = False
+
+        department, products = add_department_products(3)
+
+        for year in [2010, 2011]:
+            for i, product in enumerate(products):
+                add_department_product_year(
+                    department, product, year=year, export_value=1000 * i,
+                    import_value=None if i == 0 else 10 * i,
+                    export_rca=i, density=0.1 * i, cog=None)
+                db.session.add(models.DepartmentIndustryYear(
+                    location_id=department.id, industry_id=i + 1,
+                    year=year, level="class", employment=i, wages=None,
+                    rca=0.5 * i, distance=0.3, cog=-0.1))
+        db.session.commit()
+
+        urls = [
+            "/data/location/{}/products/?level=4digit".format(department.id),
+            "/data/location/{}/industries/?level=class".format(department.id),
+            "/data/product/{}/exporters/?level=department".format(products[1].id),
+            "/data/industry/2/participants/?level=department",
+            "/data/product/9999/exporters/?level=department",
+        ]
+        urls += [url + "&format=columnar" for url in urls]
+        urls += [
+            "/data/location/{}/products/?level=4digit&fields=export_rca,"
+            "department_id&year=2011".format(department.id),
+            "/data/location/{}/industries/?level=class&format=columnar"
+            "&fields=rca".format(department.id),
+        ]
+
+        self.app.config["DATA_ENGINE"] = "sql"
+        sql_responses = [self.client.get(url).data for url in urls]
+
+        self.app.config["DATA_ENGINE"] = "columnar"
+        columnar_responses = [self.client.get(url).data for url in urls]
+
+        assert sql_responses == columnar_responses
+
+
+class TestCompiledSerializer(BaseTestCase):
+
+    def test_same_output_as_marshmallow(self):
+        department, products = add_department_products(3)
+        for i, product in enumerate(products):
+            add_department_product_year(
+                department, product, export_value=1000 * i,
+                import_value=None if i == 0 else 10 * i, export_rca=i,
+                cog=None)
+        db.session.commit()
+
+        model = models.DepartmentProductYear
+        schema = schemas.XProductYearSchema(many=True)
+        schema.context["id_field_name"] = "department_id"
+        columns = [getattr(model, name) for name in ["export_value",
+                   "import_value", "export_rca", "product_id", "location_id",
+                   "year"]]
+
+        datasets = [
+            model.query.all(),
+            db.session.query(*columns).all(),
+            [{"export_value": 5, "import_value": None, "location_id": 1,
+              "import_num_plants": 2, "export_num_plants": 3,
+              "product_id": 3, "year": 2012},
+             {"import_value": 2.5, "product_id": 3}],
+        ]
+        for data in datasets:
+            assert schemas.compile_schema(schema, data[0]) is not None
+            assert schemas.fast_dump(schema, data) == schema.dump(data).data
+
+        assert schemas.fast_dump(schema, datasets[0][0], many=False) == \
+            schema.dump(datasets[0][0], many=False).data
+
+        schema = schemas.XProductYearSchema(many=True)
+        with pytest.raises(ma.ValidationError):
+            schemas.fast_dump(schema, datasets[0])
+
+    def test_schema_query_matches_orm(self):
+        from colombia.data.views import schema_query
+
+        department, (product,) = add_department_products()
+        add_department_product_year(department, product, export_value=10,
+                                    density=0.25)
+        db.session.commit()
+
+        model = models.DepartmentProductYear
+        schema = schemas.XProductYearSchema(many=True)
+        schema.context["id_field_name"] = "department_id"
+
+        rows = schema_query(model, schema).all()
+        assert not isinstance(rows[0], model)
+        assert schemas.fast_dump(schema, rows) == \
+            schemas.fast_dump(schema, model.query.all())
+        assert rows[0].distance == 0.75
+
+
+class TestStreaming(BaseTestCase):
+
+    def test_streamed_response(self):
+        self.app.config["RESPONSE_CACHE"] = False
+
+        department, products = add_department_products(5)
+        for i, product in enumerate(products):
+            add_department_product_year(department, product, export_value=i,
+                                        import_value=None)
+        db.session.commit()
+
+        url = "/data/location/{}/products/?level=4digit".format(department.id)
+        response = self.client.get(url)
+
+        self.app.config["STREAM_RESPONSES"] = True
+        self.app.config["STREAM_CHUNK_SIZE"] = 2
+        streamed = self.client.get(url)
+        assert json.loads(streamed.data.decode("utf-8")) == response.json
+
+        url = "/data/location/{}/products/?level=2digit".format(department.id)
+        streamed = self.client.get(url)
+        assert json.loads(streamed.data.decode("utf-8")) == {"data": []}
+
+
+class TestYearFilters(BaseTestCase):
+
+    def test_year_filters(self):
+        department, (product,) = add_department_products()
+        for year in [2010, 2011, 2012, 2013]:
+            add_department_product_year(department, product, year=year,
+                                        export_value=year)
+        db.session.commit()
+
+        url = "/data/location/{}/products/?level=4digit".format(department.id)
+
+        def years(query_string):
+            response = self.client.get(url + query_string)
+            self.assert_200(response)
+            return [row["year"] for row in response.json["data"]]
+
+        assert years("") == [2010, 2011, 2012, 2013]
+        assert years("&year=2011") == [2011]
+        assert years("&from_year=2011&to_year=2012") == [2011, 2012]
+        assert years("&from_year=2012") == [2012, 2013]
+        assert years("&to_year=2010") == [2010]
+
+        self.assert400(self.client.get(url + "&year=abc"))
+        self.assert400(self.client.get(url + "&year=2011&to_year=2012"))
+
+
+class TestFieldProjection(BaseTestCase):
+
+    def test_fields(self):
+        department, (product,) = add_department_products()
+        add_department_product_year(department, product, export_value=10,
+                                    import_value=5)
+        db.session.add(models.DepartmentYear(
+            location_id=department.id, year=2012, eci=1.5, gdp_real=100))
+        db.session.commit()
+
+        url = "/data/location/{}/products/?level=4digit".format(department.id)
+        response = self.client.get(url + "&fields=export_value,department_id")
+        self.assert_200(response)
+        assert response.json["data"] == [
+            {"export_value": 10, "department_id": department.id}]
+
+        response = self.client.get(url + "&fields=year")
+        assert response.json["data"] == [{"year": 2012}]
+
+        self.assert400(self.client.get(url + "&fields=location_id"))
+        self.assert400(self.client.get(url + "&fields="))
+
+        response = self.client.get(
+            "/data/location/?level=department&fields=eci,year")
+        assert response.json["data"] == [{"eci": 1.5, "year": 2012}]
+
+    def test_columnar_format(self):
+        department, products = add_department_products(3)
+        for i, product in enumerate(products):
+            add_department_product_year(department, product, export_value=i,
+                                        import_value=None)
+        db.session.commit()
+
+        url = "/data/location/{}/products/?level=4digit".format(department.id)
+        rows = self.client.get(url).json["data"]
+        response = self.client.get(url + "&format=columnar").json
+
+        assert "department_id" in response["columns"]
+        assert sorted(response["columns"]) == sorted(response["data"])
+        columns = [response["data"][name] for name in response["columns"]]
+        assert [dict(zip(response["columns"], values))
+                for values in zip(*columns)] == rows
+
+        response = self.client.get(url + "&format=columnar&fields=year")
+        assert response.json == {"columns": ["year"],
+                                 "data": {"year": [2012, 2012, 2012]}}
+
+        self.assert400(self.client.get(url + "&format=xml"))
+
+
+class TestSubregionsTrade(BaseTestCase):
+
+    def test_subregions_trade(self):
+        country = factories.Location(level="country")
+        db.session.commit()
+        departments = [factories.Location(level="department",
+                                          parent_id=country.id)
+                       for i in range(2)]
+        db.session.commit()
+
+        for i, department in enumerate(departments):
+            db.session.add(models.DepartmentYear(
+                location_id=department.id, year=2012, export_value=10 * i,
+                import_value=5, export_num_plants=i, import_num_plants=1))
+        # Only demographic variables, so no trade totals
+        db.session.add(models.DepartmentYear(
+            location_id=departments[0].id, year=2013, population=100))
+        # Only imports
+        db.session.add(models.DepartmentYear(
+            location_id=departments[1].id, year=2014, import_value=7,
+            import_num_plants=2))
+        db.session.commit()
+
+        url = "/data/location/{}/subregions_trade/?level=department"\
+            .format(country.id)
+        response = self.client.get(url + "&year=2012")
+        self.assert_200(response)
+        assert sorted(response.json["data"],
+                      key=lambda row: row["location_id"]) == [
+            {"location_id": department.id, "year": 2012,
+             "export_value": 10 * i, "import_value": 5,
+             "export_num_plants": i, "import_num_plants": 1}
+            for i, department in enumerate(departments)]
+
+        response = self.client.get(url + "&year=2013")
+        assert response.json["data"] == []
+
+        response = self.client.get(url + "&year=2014")
+        assert response.json["data"] == [
+            {"location_id": departments[1].id, "year": 2014,
+             "export_value": None, "import_value": 7,
+             "export_num_plants": None, "import_num_plants": 2}]
+
+
+class TestBinaryFormats(BaseTestCase):
+
+    def setUp(self):
+        super(TestBinaryFormats, self).setUp()
+        self.department, products = add_department_products(3)
+        for i, product in enumerate(products):
+            add_department_product_year(
+                self.department, product, export_value=i, export_rca=None,
+                import_value=None if i == 0 else 0.5 * i)
+        db.session.commit()
+        self.url = "/data/location/{}/products/?level=4digit"\
+            .format(self.department.id)
+
+    def test_msgpack_round_trip(self):
+        msgpack = pytest.importorskip("msgpack")
+        rows = self.client.get(self.url).json["data"]
+
+        response = self.client.get(
+            self.url, headers={"Accept": "application/x-msgpack"})
+        assert response.mimetype == "application/x-msgpack"
+        assert "Accept" in response.headers["Vary"]
+        assert msgpack.unpackb(response.data, raw=False) == {"data": rows}
+
+    def test_arrow_round_trip(self):
+        pa = pytest.importorskip("pyarrow")
+        rows = self.client.get(self.url).json["data"]
+
+        response = self.client.get(
+            self.url, headers={"Accept": "application/vnd.apache.arrow.stream"})
+        assert response.mimetype == "application/vnd.apache.arrow.stream"
+        table = pa.ipc.open_stream(response.data).read_all()
+        assert table.to_pylist() == rows
+
+    def test_defaults_to_json(self):
+        response = self.client.get(self.url, headers={"Accept": "text/html"})
+        assert response.mimetype == "application/json"
+
+
+class TestRectangularize(BaseTestCase):
+
+    def test_matches_reference(self):
+        pytest.importorskip("numpy")
+        pytest.importorskip("pandas")
+        from colombia.benchmarks import rectangularize_reference
+        from colombia.data.views import rectangularize
+
+        values = [None, 0, 1, 2, -3, 10 ** 20, 1.5, True, "a", "b"]
+        for seed in range(500):
+            rng = random.Random(seed)
+            keys = ["key{}".format(i) for i in range(rng.randint(1, 3))]
+            pools = [rng.sample(values, rng.randint(1, 5)) for key in keys]
+            data = []
+            for i in range(rng.randint(0, 30)):
+                row = {key: rng.choice(pool) for key, pool in zip(keys, pools)}
+                row["value"] = i
+                data.append(row)
+
+            expected = rectangularize_reference(data, keys)
+            result = rectangularize(data, keys)
+            assert result == expected
+
+            # Without numpy
+            with patch.dict(sys.modules, {"numpy": None}):
+                assert rectangularize(data, keys) == expected
+
+            # Rows that existed are passed through, not copied
+            data_ids = set(id(row) for row in data)
+            for row, expected_row in zip(result, expected):
+                assert (row is expected_row) == (id(expected_row) in data_ids)
+
+
+class TestAggregateFacet(BaseTestCase):
+
+    def test_matches_reference(self):
+        pd = pytest.importorskip("pandas")
+        np = pytest.importorskip("numpy")
+        from colombia.benchmarks import (aggregate_facet_reference, first,
+                                         sum_group)
+        from colombia.dataset_tools import aggregate_facet
+
+        def null(x):
+            sample = x.first()
+            return pd.DataFrame(index=sample.index, columns=sample.columns)
+
+        aggregations = {"value": first, "count": sum_group, "name": first,
+                        "other": null}
+        for seed in range(100):
+            rng = np.random.RandomState(seed)
+            num_rows = rng.randint(1, 100)
+            df = pd.DataFrame({
+                "location_id": rng.randint(0, 5, num_rows).astype(float),
+                "year": rng.randint(2010, 2013, num_rows),
+                "value": rng.rand(num_rows),
+                "count": rng.randint(0, 10, num_rows),
+                "name": rng.choice(["a", "b"], num_rows),
+                "other": rng.rand(num_rows),
+            })
+            df.loc[rng.rand(num_rows) < 0.2, "value"] = None
+            df.loc[rng.rand(num_rows) < 0.1, "location_id"] = None
+
+            for facet_fields in [("location_id", "year"), "location_id"]:
+                expected = aggregate_facet_reference(df, facet_fields,
+                                                     aggregations)
+                result = aggregate_facet(df, facet_fields, aggregations)
+                assert result.equals(expected)
+
+
+class TestRollups(BaseTestCase):
+
+    def test_rollup_products(self):
+        pd = pytest.importorskip("pandas")
+        from colombia.hierarchy import build_closure
+        from colombia.rollups import rollup
+
+        factories.HSProduct(id=1, level="section", parent_id=None)
+        factories.HSProduct(id=2, level="2digit", parent_id=1)
+        factories.HSProduct(id=3, level="4digit", parent_id=2)
+        factories.HSProduct(id=4, level="4digit", parent_id=2)
+        db.session.commit()
+        build_closure(["product"])
+
+        df = pd.DataFrame({
+            "location_id": [7, 7, 8],
+            "product_id": [3, 4, 3],
+            "year": [2012, 2012, 2012],
+            "level": ["4digit", "4digit", "4digit"],
+            "export_value": [1, 2, 4],
+            "import_value": [10, 20, 40],
+            "export_rca": [1, 0, 1],
+        })
+        rows = rollup(df, "product")\
+            .sort_values(["location_id", "product_id"])\
+            .to_dict("records")
+
+        # Non additive metrics like export_rca aren't rolled up
+        assert rows == [
+            {"location_id": 7, "year": 2012, "product_id": 1,
+             "level": "section", "export_value": 3, "import_value": 30},
+            {"location_id": 7, "year": 2012, "product_id": 2,
+             "level": "2digit", "export_value": 3, "import_value": 30},
+            {"location_id": 8, "year": 2012, "product_id": 1,
+             "level": "section", "export_value": 4, "import_value": 40},
+            {"location_id": 8, "year": 2012, "product_id": 2,
+             "level": "2digit", "export_value": 4, "import_value": 40},
+        ]
+
+        sections = rollup(df, "product", ["section"])
+        assert list(sections["level"].unique()) == ["section"]
+
+    def test_rollup_unknown_values(self):
+        pd = pytest.importorskip("pandas")
+        from colombia.hierarchy import build_closure
+        from colombia.rollups import rollup
+
+        factories.HSProduct(id=1, level="section", parent_id=None)
+        factories.HSProduct(id=2, level="2digit", parent_id=1)
+        factories.HSProduct(id=3, level="4digit", parent_id=2)
+        factories.HSProduct(id=4, level="4digit", parent_id=2)
+        db.session.commit()
+        build_closure(["product"])
+
+        # Imports are unknown for both products of location 8, and for one
+        # of the products of location 7
+        df = pd.DataFrame({
+            "location_id": [7, 7, 8, 8],
+            "product_id": [3, 4, 3, 4],
+            "year": [2012, 2012, 2012, 2012],
+            "level": ["4digit", "4digit", "4digit", "4digit"],
+            "export_value": [1, 2, 4, 8],
+            "import_value": [10, None, None, None],
+        })
+        rows = rollup(df, "product", ["section"])\
+            .sort_values("location_id")
+        assert rows["export_value"].tolist() == [3, 12]
+        assert rows["import_value"].iloc[0] == 10
+        assert pd.isnull(rows["import_value"].iloc[1])
+
+    def test_rollup_farm_counts(self):
+        pd = pytest.importorskip("pandas")
+        from colombia.hierarchy import build_closure
+        from colombia.rollups import rollup
+
+        db.session.add(models.Livestock(id=1, level="level0", code="0"))
+        db.session.add(models.Livestock(id=2, level="level1", code="1",
+                                        parent_id=1))
+        db.session.add(models.Livestock(id=3, level="level1", code="2",
+                                        parent_id=1))
+        db.session.commit()
+        build_closure(["livestock"])
+
+        # The same single farm keeps both kinds of livestock, so the farm
+        # count can't be summed up to level0
+        df = pd.DataFrame({
+            "location_id": [7, 7],
+            "livestock_id": [2, 3],
+            "livestock_level": ["level1", "level1"],
+            "num_livestock": [10, 5],
+            "num_farms": [1, 1],
+        })
+        rows = rollup(df, "livestock").to_dict("records")
+        assert rows == [{"location_id": 7, "livestock_id": 1,
+                         "livestock_level": "level0", "num_livestock": 15}]
+
+
+class TestBatch(BaseTestCase):
+
+    def test_batch_matches_single_requests(self):
+        departments = [factories.Location(level="department")
+                       for i in range(2)]
+        municipality = factories.Location(level="municipality")
+        product = factories.HSProduct(level="4digit")
+        db.session.commit()
+        for i, department in enumerate(departments):
+            add_department_product_year(department, product, export_value=i)
+        db.session.add(models.MunicipalityProductYear(
+            location_id=municipality.id, product_id=product.id, year=2012,
+            level="4digit", export_value=7))
+        db.session.commit()
+
+        locations = departments + [municipality]
+        ids = ",".join(str(location.id) for location in locations)
+        response = self.client.get(
+            "/data/location/products/?level=4digit&ids=" + ids)
+        self.assert_200(response)
+        assert len(response.json["data"]) == 3
+        for location in locations:
+            single = self.client.get(
+                "/data/location/{}/products/?level=4digit"
+                .format(location.id))
+            assert response.json["data"][str(location.id)] == \
+                single.json["data"]
+
+        response = self.client.get(
+            "/data/location/products/?level=4digit&fields=export_value&ids="
+            + ids)
+        assert response.json["data"][str(municipality.id)] == \
+            [{"export_value": 7}]
+
+        # Other formats get one table, so the ids need to be at one level
+        department_ids = ",".join(str(department.id)
+                                  for department in departments)
+        response = self.client.get(
+            "/data/location/products/?level=4digit&format=columnar"
+            "&fields=department_id,export_value&ids=" + department_ids)
+        self.assert_200(response)
+        assert response.json["data"] == {
+            "department_id": [department.id for department in departments],
+            "export_value": [0, 1]}
+        self.assert400(self.client.get(
+            "/data/location/products/?level=4digit&format=columnar&ids="
+            + ids))
+
+    def test_batch_errors(self):
+        self.app.config["BATCH_MAX_IDS"] = 2
+        url = "/data/location/products/?level=4digit&ids="
+        self.assert400(self.client.get(url + "1,2,3"))
+        self.assert400(self.client.get(url + "a"))
+        self.assert400(self.client.get(url))
+        self.assert400(self.client.get(
+            "/data/location/partners/?level=country&ids=1"))
+
+
+class TestProfile(BaseTestCase):
+
+    def add_profile_data(self):
+        msa = factories.Location(level="msa")
+        department, (product,) = add_department_products()
+        add_department_product_year(department, product, export_value=10)
+        db.session.add(models.MSAProductYear(
+            location_id=msa.id, product_id=product.id, year=2012,
+            level="4digit", export_value=20))
+        db.session.add(models.DepartmentYear(
+            location_id=department.id, year=2012, eci=1.5))
+        db.session.commit()
+        return department, msa
+
+    def assert_profile(self, department, msa):
+        response = self.client.get(
+            "/data/location/{}/profile/".format(department.id))
+        self.assert_200(response)
+        profile = response.json["data"]
+
+        assert sorted(profile) == sorted(["year"] + list(
+            views.PROFILE_SUBDATASETS))
+        assert profile["year"] == self.client.get(
+            "/data/location/?level=department").json["data"]
+        for subdataset, level in views.PROFILE_SUBDATASETS.items():
+            single = self.client.get("/data/location/{}/{}/?level={}".format(
+                department.id, subdataset, level))
+            assert profile[subdataset] == single.json["data"]
+        assert len(profile["products"]) == 1
+
+        # Parts that don't exist at the location's level are null
+        profile = self.client.get(
+            "/data/location/{}/profile/".format(msa.id)).json["data"]
+        assert profile["livestock"] is None
+        assert profile["products"][0]["export_value"] == 20
+
+        self.assert404(self.client.get("/data/location/12345/profile/"))
+
+    def test_location_profile(self):
+        self.assert_profile(*self.add_profile_data())
+
+    def test_profile_errors_surface(self):
+        department, msa = self.add_profile_data()
+        subdataset_rows = Mock(side_effect=RuntimeError("database is down"))
+        original = views.location_subdataset_rows
+        views.location_subdataset_rows = subdataset_rows
+        try:
+            with pytest.raises(RuntimeError):
+                self.client.get(
+                    "/data/location/{}/profile/".format(department.id))
+        finally:
+            views.location_subdataset_rows = original
+
+
+_, profile_database = tempfile.mkstemp(suffix=".db")
+
+
+class TestConcurrentProfile(TestProfile):
+    """The parts are only fetched on the executor's threads with a database
+    that more than one connection can see."""
+
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + profile_database
+
+    def test_location_profile(self):
+        assert not views.in_memory_database()
+        super(TestConcurrentProfile, self).test_location_profile()
+        assert "profile_executor" in self.app.extensions
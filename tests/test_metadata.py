@@ -1,7 +1,12 @@
 from flask import url_for
 
-from colombia import factories
+import gzip
+import json
+
+from colombia import factories, models
 from colombia.core import db
+from colombia.hierarchy import build_closure
+from colombia.versioning import stamp_dataset_version
 
 from . import BaseTestCase
 
@@ -202,3 +207,142 @@ class TestMetadataAPIs(BaseTestCase):
                                          "parent_id", "name_en",
                                          "name_short_en",
                                          "description_en"])
+
+    def test_responses_cached_per_dataset_version(self):
+
+        self.app.config["DATASET_VERSION_TTL"] = 0
+        stamp_dataset_version("first")
+
+        factories.Location(id=1, code="03", level="department")
+        db.session.commit()
+
+        response = self.client.get(url_for("metadata.location"))
+        assert len(response.json["data"]) == 1
+
+        # Same version, so we get the cached response despite the new row
+        factories.Location(id=2, code="04", level="department")
+        db.session.commit()
+        response = self.client.get(url_for("metadata.location"))
+        assert len(response.json["data"]) == 1
+
+        # Different ?level= is a different key
+        response = self.client.get(url_for("metadata.location",
+                                           level="department"))
+        assert len(response.json["data"]) == 2
+
+        # A new import invalidates the cache
+        stamp_dataset_version("second")
+        response = self.client.get(url_for("metadata.location"))
+        assert len(response.json["data"]) == 2
+
+    def test_conditional_get(self):
+
+        self.app.config["DATASET_VERSION_TTL"] = 0
+        self.app.config["CACHE_CONTROL_MAX_AGE"] = {"metadata": 600}
+        stamp_dataset_version("first")
+
+        factories.Location(id=1, code="03", level="department")
+        db.session.commit()
+
+        response = self.client.get(url_for("metadata.location"))
+        self.assert_200(response)
+        etag = response.headers["ETag"]
+        assert response.cache_control.max_age == 600
+        assert response.cache_control.public
+
+        response = self.client.get(url_for("metadata.location"),
+                                   headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+        assert response.headers["ETag"] == etag
+
+        # Different request, different ETag
+        response = self.client.get(url_for("metadata.location",
+                                           level="department"),
+                                   headers={"If-None-Match": etag})
+        self.assert_200(response)
+        assert response.headers["ETag"] != etag
+
+        # A new import changes the ETag
+        stamp_dataset_version("second")
+        response = self.client.get(url_for("metadata.location"),
+                                   headers={"If-None-Match": etag})
+        self.assert_200(response)
+        assert response.headers["ETag"] != etag
+
+    def test_compressed_responses(self):
+
+        self.app.config["COMPRESS_MIN_SIZE"] = 0
+        for i in range(5):
+            factories.Location(level="department")
+        db.session.commit()
+
+        plain = self.client.get(url_for("metadata.location"))
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        for i in range(2):
+            # The second one is served compressed from the response cache
+            response = self.client.get(url_for("metadata.location"),
+                                       headers={"Accept-Encoding": "gzip"})
+            assert response.headers["Content-Encoding"] == "gzip"
+            body = gzip.decompress(response.data).decode("utf-8")
+            assert json.loads(body) == plain.json
+
+        assert response.headers["ETag"] != plain.headers["ETag"]
+
+    def test_hierarchy(self):
+
+        factories.HSProduct(id=1, level="section", code="A", parent_id=None)
+        factories.HSProduct(id=2, level="2digit", code="11", parent_id=1)
+        factories.HSProduct(id=3, level="4digit", code="1108", parent_id=2)
+        factories.HSProduct(id=4, level="4digit", code="1109", parent_id=2)
+        factories.Location(id=1, code="COL", level="country")
+        factories.Location(id=2, code="05", level="department", parent_id=1)
+        factories.Location(id=3, code="05001", level="municipality",
+                           parent_id=2)
+        db.session.commit()
+        build_closure()
+
+        def hierarchy(entity_name, from_level, to_level):
+            return self.client.get(url_for("metadata.hierarchy",
+                                           entity_name=entity_name,
+                                           from_level=from_level,
+                                           to_level=to_level))
+
+        response = hierarchy("products", "4digit", "section")
+        self.assert_200(response)
+        assert response.json["data"] == {"3": 1, "4": 1}
+
+        assert hierarchy("products", "4digit", "2digit").json["data"] == \
+            {"3": 2, "4": 2}
+        assert hierarchy("products", "2digit", "2digit").json["data"] == \
+            {"2": 2}
+        assert hierarchy("products", "section", "4digit").json["data"] == {}
+        assert hierarchy("locations", "municipality", "country")\
+            .json["data"] == {"3": 1}
+
+        # Industries 4digit is the old name of class, and classes map to
+        # their section, not to their grandparent division like they used to
+        for id, level, parent_id in [(10, "section", None),
+                                     (11, "division", 10),
+                                     (12, "group", 11),
+                                     (13, "class", 12),
+                                     (14, "class", 12)]:
+            db.session.add(models.Industry(id=id, level=level,
+                                           code=str(id), parent_id=parent_id))
+        db.session.commit()
+        build_closure(["industry"])
+
+        assert hierarchy("industries", "4digit", "section")\
+            .json["data"] == {"13": 10, "14": 10}
+        assert hierarchy("industries", "class", "section").json["data"] == \
+            {"13": 10, "14": 10}
+        assert hierarchy("industries", "4digit", "division")\
+            .json["data"] == {"13": 11, "14": 11}
+        assert hierarchy("industries", "group", "section")\
+            .json["data"] == {"12": 10}
+
+        self.assert400(hierarchy("products", "class", "section"))
+        self.assert400(hierarchy("products", None, "section"))
+        self.assert400(hierarchy("cats", "4digit", "section"))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# The process cache is part of the ingestion, which needs pandas
+pd = pytest.importorskip("pandas")
+
+from colombia.process_cache import (ProcessCache, fingerprint,  # noqa
+                                    record_input, recording)
+
+from . import BaseTestCase
+
+
+def make_dataset(year):
+    return {
+        "read_function": lambda: pd.DataFrame({"year": [year]}),
+        "field_mapping": {"year": "year"},
+        "facets": {("year",): {"year": year}},
+    }
+
+
+class TestProcessCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestProcessCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source.dta")
+        with open(self.source, "w") as f:
+            f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestProcessCache, self).tearDown()
+
+    def make_result(self, size=10):
+        return {("year",): pd.DataFrame({"value": range(size)})}
+
+    def test_fingerprint(self):
+        assert fingerprint(make_dataset(2010)) == \
+            fingerprint(make_dataset(2010))
+        assert fingerprint(make_dataset(2010)) != \
+            fingerprint(make_dataset(2011))
+
+    def test_recording(self):
+        with recording() as paths:
+            assert record_input("a.dta") == "a.dta"
+        record_input("b.dta")
+        assert paths == {"a.dta"}
+
+    def test_get_put(self):
+        cache = ProcessCache(10 ** 6)
+        key = cache.key(make_dataset(2010))
+        assert cache.get(key) is None
+
+        cache.put(key, [self.source], self.make_result())
+        ret = cache.get(key)
+        assert ret[("year",)].equals(self.make_result()[("year",)])
+
+        # Callers get their own copy
+        ret[("year",)]["value"] = 0
+        assert cache.get(key)[("year",)].equals(self.make_result()[("year",)])
+
+        # Stale once the source changes
+        with open(self.source, "w") as f:
+            f.write("new data")
+        assert cache.get(key) is None
+
+    def test_eviction(self):
+        ret = self.make_result(1000)
+        cache = ProcessCache(ret[("year",)].memory_usage(deep=True).sum() * 2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, [], self.make_result(1000))
+        assert list(cache.entries) == ["b", "c"]
+        assert cache.size <= cache.max_bytes
+
+        cache.get("b")
+        cache.put("d", [], self.make_result(1000))
+        assert list(cache.entries) == ["b", "d"]
+
+    def test_spill(self):
+        spill_dir = os.path.join(self.tmpdir, "cache")
+        ProcessCache(10 ** 6, spill_dir).put("a", [self.source],
+                                             self.make_result())
+
+        cache = ProcessCache(10 ** 6, spill_dir)
+        assert cache.get("a")[("year",)].equals(
+            self.make_result()[("year",)])
+        assert cache.get("b") is None
@@ -0,0 +1,70 @@
+import pytest
+
+from colombia.scheduler import Task, check_graph, run_graph
+
+from . import BaseTestCase
+
+
+def add(value, inputs):
+    return value + sum(inputs.values())
+
+
+def fail(inputs):
+    raise RuntimeError("failed")
+
+
+initialized = []
+
+
+def initialize():
+    initialized.append(True)
+
+
+def times_initialized(inputs):
+    return len(initialized)
+
+
+class TestScheduler(BaseTestCase):
+
+    def make_tasks(self):
+        return {
+            "a": Task(add, (1,), ()),
+            "b": Task(add, (2,), ()),
+            "c": Task(add, (10,), ("a", "b")),
+            "d": Task(add, (100,), ("c", "a")),
+        }
+
+    def test_check_graph(self):
+        order = check_graph(self.make_tasks())
+        assert order.index("c") > order.index("a")
+        assert order.index("c") > order.index("b")
+        assert order.index("d") > order.index("c")
+
+        with pytest.raises(ValueError):
+            check_graph({"a": Task(add, (1,), ("b",)),
+                         "b": Task(add, (1,), ("a",))})
+        with pytest.raises(ValueError):
+            check_graph({"a": Task(add, (1,), ("missing",))})
+
+    def test_run_graph(self):
+        expected = {"a": 1, "b": 2, "c": 13, "d": 114}
+        assert run_graph(self.make_tasks(), workers=1) == expected
+        assert run_graph(self.make_tasks(), workers=2) == expected
+
+    def test_initializer(self):
+        tasks = {name: Task(times_initialized, (), ())
+                 for name in ["a", "b", "c", "d"]}
+        results = run_graph(tasks, workers=1, initializer=initialize)
+        assert results == {"a": 0, "b": 0, "c": 0, "d": 0}
+
+        # Once per worker process, before its first task
+        results = run_graph(tasks, workers=2, initializer=initialize)
+        assert set(results.values()) == {1}
+        assert initialized == []
+
+    def test_failures_propagate(self):
+        tasks = self.make_tasks()
+        tasks["b"] = Task(fail, (), ())
+        for workers in [1, 2]:
+            with pytest.raises(RuntimeError):
+                run_graph(tasks, workers=workers)
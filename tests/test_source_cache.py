@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# The source cache is part of the ingestion, which needs pandas
+pd = pytest.importorskip("pandas")
+
+from colombia import source_cache  # noqa
+from colombia.source_cache import cached_read  # noqa
+
+from . import BaseTestCase
+
+
+class TestSourceCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestSourceCache, self).setUp()
+        pytest.importorskip("pyarrow")
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.source = os.path.join(self.tmpdir, "source.dta")
+        self.reads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestSourceCache, self).tearDown()
+
+    def read_stata(self, path):
+        self.reads += 1
+        return pd.read_stata(path)
+
+    def write_source(self, value):
+        df = pd.DataFrame({"r": ["05", "08"], "p": [1, 2],
+                           "export_value": [value, 2.5]})
+        df.to_stata(self.source, write_index=False)
+
+    def test_read_through(self):
+        self.write_source(1.5)
+        expected = pd.read_stata(self.source)
+
+        first = cached_read(self.cache_dir, self.read_stata, self.source,
+                            buffered=True)
+        second = cached_read(self.cache_dir, self.read_stata, self.source,
+                             buffered=True)
+        pd.testing.assert_frame_equal(first, expected)
+        pd.testing.assert_frame_equal(second, expected)
+        assert self.reads == 1
+
+        # Touched but the same contents
+        stat = os.stat(self.source)
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 10))
+        cached_read(self.cache_dir, self.read_stata, self.source,
+                    buffered=True)
+        assert self.reads == 1
+
+        # Changed
+        self.write_source(3.5)
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 20))
+        changed = cached_read(self.cache_dir, self.read_stata, self.source,
+                              buffered=True)
+        assert changed.export_value.tolist() == [3.5, 2.5]
+        assert self.reads == 2
+
+    def test_unbuffered(self):
+        self.write_source(1.5)
+        cached_read(self.cache_dir, self.read_stata, self.source)
+        cached_read(self.cache_dir, self.read_stata, self.source)
+        assert self.reads == 1
+
+        # Without a hash from the first read, any new mtime means a new read
+        stat = os.stat(self.source)
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 10))
+        cached_read(self.cache_dir, self.read_stata, self.source)
+        assert self.reads == 2
+
+    def test_lost_rename(self):
+        self.write_source(1.5)
+        key = source_cache.cache_key(self.read_stata, self.source, (), {})
+        # Something else holds the cached copy's name, so the rename fails
+        os.makedirs(os.path.join(self.cache_dir, key + ".feather"))
+
+        df = cached_read(self.cache_dir, self.read_stata, self.source)
+        pd.testing.assert_frame_equal(df, pd.read_stata(self.source))
+        assert sorted(os.listdir(self.cache_dir)) == [key + ".feather"]
+
+    def test_index(self):
+        df = pd.DataFrame({"value": [1, 2]},
+                          index=pd.Index(["a", "b"], name="code"))
+        stored, index = source_cache.to_columnar(df)
+        pd.testing.assert_frame_equal(
+            source_cache.from_columnar(stored, index), df)
+
+    def test_no_cache_dir(self):
+        self.write_source(1.5)
+        cached_read(None, self.read_stata, self.source)
+        cached_read(None, self.read_stata, self.source)
+        assert self.reads == 2